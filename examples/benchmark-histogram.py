@@ -0,0 +1,76 @@
+"""Micro-benchmark of the DRMM matching histograms (batched vs. loop)"""
+
+import time
+import click
+import torch
+
+from xpmir.neural.drmm import CountHistogram, LogCountHistogram, NormalizedHistogram
+
+
+def loop_histogram(nbins, simmat, dtoks, qtoks):
+    """The original implementation (one bincount per query term)"""
+    BATCH, CHANNELS, QLEN, DLEN = simmat.shape
+    bins = ((simmat + 1.00001) / 2.0 * (nbins - 1)).int()
+    weights = (
+        (dtoks != -1).reshape(BATCH, 1, DLEN).expand(BATCH, QLEN, DLEN)
+        * (qtoks != -1).reshape(BATCH, QLEN, 1).expand(BATCH, QLEN, DLEN)
+    ).float()
+    histogram = []
+    for superbins, w in zip(bins, weights):
+        result = []
+        for b in superbins:
+            result.append(
+                torch.stack([torch.bincount(q, x, nbins) for q, x in zip(b, w)], dim=0)
+            )
+        histogram.append(torch.stack(result, dim=0))
+    return torch.stack(histogram, dim=0)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+@click.option("--batch", type=int, default=64)
+@click.option("--qlen", type=int, default=20)
+@click.option("--dlen", type=int, default=2000)
+@click.option("--channels", type=int, default=1)
+@click.option("--repeat", type=int, default=5)
+@click.command()
+def cli(batch, qlen, dlen, channels, repeat):
+    """Compares the batched histograms with the original loop"""
+    torch.manual_seed(0)
+    simmat = torch.rand(batch, channels, qlen, dlen) * 2 - 1
+    qlens = torch.randint(1, qlen + 1, (batch,))
+    dlens = torch.randint(1, dlen + 1, (batch,))
+    qtoks = torch.where(torch.arange(qlen) < qlens.reshape(-1, 1), 1, -1)
+    dtoks = torch.where(torch.arange(dlen) < dlens.reshape(-1, 1), 1, -1)
+
+    reference = loop_histogram(29, simmat, dtoks, qtoks)
+    expected = {
+        "count": reference,
+        "normalized": reference / dlens.reshape(batch, 1, 1, 1).float(),
+        "logcount": (reference.float() + 1e-5).log(),
+    }
+
+    for name, hist in (
+        ("count", CountHistogram(nbins=29).instance()),
+        ("normalized", NormalizedHistogram(nbins=29).instance()),
+        ("logcount", LogCountHistogram(nbins=29).instance()),
+    ):
+        result = hist(simmat, dlens, dtoks, qtoks)
+        assert torch.equal(result, expected[name]), f"{name}: results differ"
+
+    hist = CountHistogram(nbins=29).instance()
+    loop = timeit(lambda: loop_histogram(29, simmat, dtoks, qtoks), repeat)
+    batched = timeit(lambda: hist(simmat, dlens, dtoks, qtoks), repeat)
+    print(f"batch={batch} qlen={qlen} dlen={dlen} channels={channels}")
+    print(f"loop:    {loop * 1000:.1f} ms")
+    print(f"batched: {batched * 1000:.1f} ms (x{loop / batched:.1f})")
+
+
+if __name__ == "__main__":
+    cli()
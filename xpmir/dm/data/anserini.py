@@ -48,6 +48,10 @@ class Index(BaseIndex):
         doc = self.index_reader.doc(docid)
         return doc.contents()
 
+    def docids(self):
+        for ix in range(self.documentcount):
+            yield self.index_reader.convert_internal_docid_to_collection_docid(ix)
+
     def term_df(self, term: str):
         x = self.index_reader.analyze(term)
         if x:
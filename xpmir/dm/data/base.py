@@ -1,3 +1,4 @@
+from typing import Iterator
 from datamaestro.definitions import data
 
 
@@ -9,6 +10,10 @@ class Index:
         """Returns the text of the document"""
         raise NotImplementedError()
 
+    def docids(self) -> Iterator[str]:
+        """Iterates over the document IDs"""
+        raise NotImplementedError()
+
     def term_df(self, term: str):
         """Returns the document frequency"""
         raise NotImplementedError()
@@ -1,6 +1,6 @@
 from pathlib import Path
 import tempfile
-from typing import List
+from typing import Iterator, List, Tuple
 from datamaestro_text.data.ir import Adhoc
 from experimaestro import param, task, pathoption, tqdm
 import xpmir as ir
@@ -12,7 +12,7 @@ from datamaestro_text.data.ir.trec import (
 
 import logging
 import xpmir.metrics as metrics
-from xpmir.rankers import Retriever
+from xpmir.rankers import Retriever, ScoredDocument
 
 
 @param("assessments", TrecAdhocAssessments)
@@ -57,10 +57,20 @@ class TrecEval:
 def _evaluate(fp, retriever: Retriever, dataset: Adhoc, measures: List[str]):
     """Evaluate a retriever on a dataset"""
     topics = list(dataset.topics.iter())
-    for query in tqdm(topics):
-        retrieved = retriever.retrieve(query.title)
+    results = ((query.qid, retriever.retrieve(query.title)) for query in tqdm(topics))
+    return _evaluate_results(fp, results, dataset, measures)
+
+
+def _evaluate_results(
+    fp,
+    results: Iterator[Tuple[str, List[ScoredDocument]]],
+    dataset: Adhoc,
+    measures: List[str],
+):
+    """Evaluate (query ID, ranked documents) pairs on a dataset"""
+    for qid, retrieved in results:
         for rank, sd in enumerate(retrieved):
-            fp.write(f"""{query.qid} Q0 {sd.docid} {rank+1} {sd.score} run\n""")
+            fp.write(f"""{qid} Q0 {sd.docid} {rank+1} {sd.score} run\n""")
     fp.flush()
 
     qrels_path = str(dataset.assessments.trecpath())
@@ -79,6 +89,21 @@ def evaluate(run_path: Path, retriever: Retriever, dataset: Adhoc, measures: Lis
         return _evaluate(fp, retriever, dataset, measures)
 
 
+def evaluate_results(
+    run_path: Path,
+    results: Iterator[Tuple[str, List[ScoredDocument]]],
+    dataset: Adhoc,
+    measures: List[str],
+):
+    """Evaluate already ranked documents (given as query ID/ranked documents pairs)"""
+    if run_path:
+        with run_path.open("wt") as fp:
+            return _evaluate_results(fp, results, dataset, measures)
+
+    with tempfile.NamedTemporaryFile("wt") as fp:
+        return _evaluate_results(fp, results, dataset, measures)
+
+
 @param("dataset", type=Adhoc)
 @param("retriever", type=Retriever)
 @param("metrics", type=List[str], default=["map", "p@20", "ndcg", "ndcg@20", "mrr"])
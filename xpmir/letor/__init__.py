@@ -1,3 +1,6 @@
+import inspect
+import os
+from typing import List
 from tqdm import tqdm
 import torch
 from experimaestro import param, option, config, pathoption
@@ -10,7 +13,7 @@ from xpmir.interfaces import apex
 # from onir.log import Logger
 
 
-from experimaestro import config, Param
+from experimaestro import config, Param, Option
 from cached_property import cached_property
 import numpy as np
 
@@ -27,10 +30,104 @@ class Random:
         return {"seed": self.seed}
 
 
+def load_checkpoint(f):
+    """Loads a (trusted) file saved with torch.save, which can hold any
+    picklable object (e.g. a whole module), whereas torch.load only loads
+    tensors by default since torch 2.6"""
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(f, weights_only=False)
+    return torch.load(f)
+
+
+def parse_cpus(spec: str) -> List[int]:
+    """Parse a list of CPU cores (e.g. 0-7,16,18-19)"""
+    cpus = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part.strip():
+            cpus.append(int(part))
+    return cpus
+
+
 @config()
 class Device:
+    """The device and the threading setup
+
+    Attributes:
+        gpu: Use the GPU (if available)
+        gpu_determ: Deterministic GPU computation
+        threads: Total number of intra-op threads (0 to use all the available
+            cores); they are divided between the processes of the task
+        interop_threads: Number of inter-op threads (0 for the torch default)
+        affinity: CPU cores (e.g. "0-15,32-47") the task should be bound to
+            (empty to use the cores available); they are divided between the
+            processes of the task
+    """
+
     gpu: Param[bool] = False
     gpu_determ: Param[bool] = False
+    threads: Option[int] = 0
+    interop_threads: Option[int] = 0
+    affinity: Option[str] = ""
+
+    def cpus(self) -> List[int]:
+        """Returns the CPU cores of the task (to be computed before the
+        affinity of the current process is changed)"""
+        if self.affinity:
+            return parse_cpus(self.affinity)
+        if hasattr(os, "sched_getaffinity"):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+    def setup(self, logger, rank: int = 0, processes: int = 1, cpus: List[int] = None):
+        """Setup the threads and CPU affinity of a process of the task
+
+        Should be called before any torch computation and before the JVM
+        (e.g. Anserini) is started.
+
+        Arguments:
+            rank: The process rank (between 0 and processes - 1)
+            processes: The number of processes of the task (training and
+                validation workers)
+            cpus: The CPU cores of the task (see `cpus`) -- processes
+                started after the affinity of their parent was set inherit
+                its restricted affinity, and should be given the cores
+                computed by the parent
+        """
+        cpus = list(cpus) if cpus is not None else self.cpus()
+
+        if processes > 1:
+            # Each process gets its own share of the cores
+            cpus = [int(cpu) for cpu in np.array_split(cpus, processes)[rank]] or cpus
+        if (self.affinity or processes > 1) and hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+
+        threads = self.threads // processes if self.threads > 0 else len(cpus)
+        threads = max(threads, 1)
+        logger.info(
+            "Process %d/%d: %d threads (cores %s)", rank + 1, processes, threads, cpus
+        )
+
+        # Used by OpenMP/MKL and inherited by child processes
+        os.environ["OMP_NUM_THREADS"] = str(threads)
+        os.environ["MKL_NUM_THREADS"] = str(threads)
+        torch.set_num_threads(threads)
+        if self.interop_threads > 0:
+            try:
+                torch.set_num_interop_threads(self.interop_threads)
+            except RuntimeError:
+                logger.warning("Inter-op threads could not be set (already in use)")
+
+        # Limit the number of cores seen by the JVM (if not started)
+        try:
+            import jnius_config
+
+            if not jnius_config.vm_running:
+                jnius_config.add_options(f"-XX:ActiveProcessorCount={threads}")
+        except ImportError:
+            pass
 
     def __call__(self, logger):
         """Called by experimaestro to substitute object at run time"""
@@ -0,0 +1,176 @@
+import multiprocessing
+import socket
+from datetime import timedelta
+from typing import Any, Callable, Iterable, List
+import torch
+import torch.distributed as dist
+from xpmir.utils import EasyLogger
+
+
+class DistributedContext(EasyLogger):
+    """Data-parallel training context of a process
+
+    With one process (the default), all the operations are no-ops. Otherwise,
+    processes communicate through torch.distributed (gloo backend, i.e. CPU)
+    and the master process (rank 0) is the one running the learner.
+    """
+
+    def __init__(self, rank: int = 0, world_size: int = 1):
+        self.rank = rank
+        self.world_size = world_size
+        self.processes = []
+
+    @property
+    def enabled(self):
+        return self.world_size > 1
+
+    @property
+    def is_master(self):
+        return self.rank == 0
+
+    @staticmethod
+    def init(
+        rank: int, world_size: int, init_method: str, timeout: float
+    ) -> "DistributedContext":
+        """Joins the process group
+
+        The timeout (in seconds) bounds the time a process waits for the
+        others, e.g. the workers waiting for the master to validate an epoch
+        """
+        dist.init_process_group(
+            "gloo",
+            init_method=init_method,
+            rank=rank,
+            world_size=world_size,
+            timeout=timedelta(seconds=timeout),
+        )
+        return DistributedContext(rank, world_size)
+
+    @staticmethod
+    def spawn(
+        world_size: int, timeout: float, worker: Callable, *args
+    ) -> "DistributedContext":
+        """Starts the worker processes (ranks 1 to world_size - 1) and returns
+        the context of the master process
+
+        The worker is called with (rank, world_size, init_method, timeout, *args)
+        """
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        init_method = f"tcp://127.0.0.1:{port}"
+
+        mp = multiprocessing.get_context("spawn")
+        processes = []
+        for rank in range(1, world_size):
+            process = mp.Process(
+                target=worker,
+                args=(rank, world_size, init_method, timeout, *args),
+                daemon=True,
+            )
+            process.start()
+            processes.append(process)
+
+        context = DistributedContext.init(0, world_size, init_method, timeout)
+        context.processes = processes
+        return context
+
+    def proceed(self, value: bool = True) -> bool:
+        """Synchronizes the processes before an epoch: returns False if the
+        master asked to stop"""
+        if not self.enabled:
+            return value
+        flag = torch.tensor([1 if value else 0])
+        dist.broadcast(flag, 0)
+        return flag.item() == 1
+
+    def stop(self):
+        """Stops the workers (master only) and waits for them"""
+        if not self.enabled:
+            return
+        self.proceed(False)
+        for process in self.processes:
+            process.join()
+        self.close()
+
+    def close(self):
+        """Leaves the process group"""
+        if self.enabled:
+            dist.destroy_process_group()
+
+    def broadcast(self, value: int) -> int:
+        """Broadcast an integer from the master"""
+        if not self.enabled:
+            return value
+        tensor = torch.tensor([value], dtype=torch.long)
+        dist.broadcast(tensor, 0)
+        return tensor.item()
+
+    def broadcast_parameters(self, parameters: Iterable[torch.Tensor]):
+        """Copy the master parameters to all the processes"""
+        if not self.enabled:
+            return
+        with torch.no_grad():
+            for parameter in parameters:
+                dist.broadcast(parameter.data, 0)
+
+    def all_reduce_gradients(self, parameters: Iterable[torch.Tensor]):
+        """Average the gradients over all the processes
+
+        All the trainable parameters are reduced, so that the processes make
+        the same collective calls: a parameter without gradient in a process
+        (e.g. not used by its batch) contributes zeros.
+        """
+        if not self.enabled:
+            return
+        parameters = [p for p in parameters if p.requires_grad]
+
+        # Sparse gradients (embeddings) are sparse in every process
+        sparse = torch.tensor(
+            [p.grad is not None and p.grad.is_sparse for p in parameters],
+            dtype=torch.uint8,
+        )
+        dist.all_reduce(sparse, op=dist.ReduceOp.MAX)
+        for p, is_sparse in zip(parameters, sparse.tolist()):
+            if p.grad is not None:
+                continue
+            grad = torch.zeros_like(p)
+            p.grad = grad.to_sparse(1) if is_sparse else grad
+
+        # Sparse gradients are reduced one by one
+        for p in parameters:
+            if p.grad.is_sparse:
+                grad = p.grad.coalesce()
+                dist.all_reduce(grad)
+                p.grad = grad / self.world_size
+
+        grads = [p.grad for p in parameters if not p.grad.is_sparse]
+        if not grads:
+            return
+
+        # Reduce all the gradients at once
+        flat = torch.cat([grad.reshape(-1) for grad in grads])
+        dist.all_reduce(flat)
+        flat /= self.world_size
+
+        offset = 0
+        for grad in grads:
+            numel = grad.numel()
+            grad.copy_(flat[offset : offset + numel].view_as(grad))
+            offset += numel
+
+    def mean(self, value: float) -> float:
+        """Average a value over all the processes"""
+        if not self.enabled:
+            return value
+        tensor = torch.tensor([value], dtype=torch.double)
+        dist.all_reduce(tensor)
+        return tensor.item() / self.world_size
+
+    def all_gather(self, obj: Any) -> List[Any]:
+        """Gather a (picklable) object from all the processes"""
+        if not self.enabled:
+            return [obj]
+        objects = [None] * self.world_size
+        dist.all_gather_object(objects, obj)
+        return objects
@@ -1,17 +1,33 @@
+import functools
 import logging
+import multiprocessing
+import queue
 import tempfile
+import traceback
 import json
 import os
 from pathlib import Path
-from typing import Dict, List
+from shutil import rmtree
+from typing import Callable, Dict, Iterator, List, Tuple
+import numpy as np
+import torch
 from datamaestro_text.data.ir import Adhoc
-from experimaestro import task, config, param, progress, pathoption
-from experimaestro.annotations import option
+from experimaestro import task, config, param, progress, pathoption, tqdm
+from experimaestro.annotations import cache, option
 from experimaestro.utils import cleanupdir
-from xpmir.evaluation import evaluate
+from xpmir.evaluation import evaluate, evaluate_results
 from xpmir.letor import Random
+from xpmir.letor.distributed import DistributedContext
+from xpmir.letor.samplers import Records
 from xpmir.letor.trainers import TrainContext, TrainState, Trainer
-from xpmir.rankers import LearnableScorer, Retriever, ScoredDocument, Scorer
+from xpmir.rankers import (
+    LearnableScorer,
+    Retriever,
+    ScoredDocument,
+    Scorer,
+    TwoStageRetriever,
+)
+from xpmir.vocab.collection import RaggedStore
 
 
 class ValidationState(TrainState):
@@ -35,12 +51,14 @@ class ValidationState(TrainState):
 class ValidationContext(TrainContext):
     STATETYPE = ValidationState
 
-    def copy(self, path: Path):
-        """Copy the state into another folder"""
-        if self.state.path is None:
-            self.save_checkpoint()
+    def copy(self, path: Path, state: ValidationState = None):
+        """Copy the state (by default, the current one) into another folder"""
+        if state is None:
+            state = self.state
+            if state.path is None:
+                self.save_checkpoint()
 
-        trainpath = self.state.path
+        trainpath = state.path
 
         if path:
             cleanupdir(path)
@@ -52,23 +70,263 @@ class ValidationContext(TrainContext):
                     os.link(f, path / relpath)
 
 
+class ValidationFixture:
+    """Frozen validation candidates (first-stage results and token IDs)
+
+    Documents token IDs are stored as a ragged memory-mapped array (one row
+    per candidate, in the documents directory) so that validating only
+    requires to run the model forward passes.
+    """
+
+    DTYPE = np.int32
+
+    def __init__(self, path: Path):
+        with (path / "info.json").open("rt") as fp:
+            info = json.load(fp)
+
+        self.qids = info["qids"]
+        self.queries = info["queries"]
+        self.queries_toks = info["queries_toks"]
+        self.queries_tokids = info["queries_tokids"]
+
+        self.scores = np.load(path / "scores.npy")
+        self.offsets = np.load(path / "offsets.npy")
+        self.documents = RaggedStore(path / "documents")
+        self.docs_tokids = self.documents.array("tokids", ValidationFixture.DTYPE)
+
+    @staticmethod
+    def build(path: Path, retriever: Retriever, dataset: Adhoc, vocab, dlen: int):
+        """Retrieve and tokenize the validation candidates"""
+        qids, queries, queries_toks, queries_tokids = [], [], [], []
+        scores, offsets = [], [0]
+
+        (path / "documents").mkdir(exist_ok=True)
+        with RaggedStore.writer(
+            path / "documents", tokids=ValidationFixture.DTYPE
+        ) as writer:
+            for query in tqdm(list(dataset.topics.iter())):
+                documents = retriever.retrieve(query.title)
+                toks = vocab.tokenize(query.title)
+                qids.append(query.qid)
+                queries.append(query.title)
+                queries_toks.append(toks)
+                queries_tokids.append(vocab.tok2ids(toks))
+
+                _, tokids, lens = vocab.batch_tokenize(
+                    [doc.content for doc in documents], maxlen=dlen
+                )
+                for doc, doc_tokids, doc_len in zip(documents, tokids, lens):
+                    writer.add(doc.docid, tokids=doc_tokids[: min(doc_len, dlen)])
+                    scores.append(doc.score)
+                offsets.append(len(scores))
+
+        np.save(path / "scores.npy", np.array(scores, dtype=np.float32))
+        np.save(path / "offsets.npy", np.array(offsets, dtype=np.int64))
+
+        # Written last: marks the fixture as complete
+        with (path / "info.json").open("wt") as fp:
+            json.dump(
+                {
+                    "qids": qids,
+                    "queries": queries,
+                    "queries_toks": queries_toks,
+                    "queries_tokids": queries_tokids,
+                },
+                fp,
+            )
+
+    def records(self, qix: int, scorer: LearnableScorer) -> Records:
+        """Returns the (pre-tokenized) records for the given query index"""
+        vocab = scorer.vocab
+        start, end = self.offsets[qix], self.offsets[qix + 1]
+        count = end - start
+
+        records = Records()
+        records.queries = [self.queries[qix]] * count
+        records.docids = self.documents.docids[start:end]
+        records.scores = self.scores[start:end].tolist()
+        records.documents = [None] * count
+        records.relevances = [None] * count
+
+        records.queries_toks = [self.queries_toks[qix]] * count
+        records.queries_tokids, records.queries_len = vocab.pad_sequences(
+            [self.queries_tokids[qix]] * count, maxlen=scorer.qlen
+        )
+        records.docs_tokids, records.docs_len = vocab.pad_sequences(
+            [self.docs_tokids[self.documents.rows(ix)] for ix in range(start, end)]
+        )
+        return records
+
+    def rerank(
+        self, scorer: LearnableScorer, topk: int
+    ) -> Iterator[Tuple[str, List[ScoredDocument]]]:
+        """Re-rank the candidates with the scorer"""
+        for qix, qid in enumerate(tqdm(self.qids)):
+            records = self.records(qix, scorer)
+            with torch.no_grad():
+                scores = scorer(records).cpu().numpy()
+
+            scoredDocuments = [
+                ScoredDocument(docid, score)
+                for docid, score in zip(records.docids, scores)
+            ]
+            scoredDocuments.sort(reverse=True)
+            yield qid, scoredDocuments[:topk]
+
+
 @param("metric", default="map")
 @param("dataset", type=Adhoc)
 @param("retriever", type=Retriever)
+@option(
+    "pretokenized",
+    default=False,
+    help="Retrieve and tokenize the candidates once (requires a two-stage retriever "
+    "with a static vocabulary): later validations only run the scorer",
+)
 @config()
 class Validation:
+    @property
+    def metrics(self):
+        return [self.metric]
+
     def initialize(self):
         self.retriever.initialize()
-        self.metrics = [self.metric]
+        self.fixture = None
+
+        if self.pretokenized:
+            assert isinstance(
+                self.retriever, TwoStageRetriever
+            ), "pre-tokenized validation requires a two-stage retriever"
+            assert (
+                self.retriever.scorer.vocab.static()
+            ), "pre-tokenized validation requires a static vocabulary"
+            self.fixture = self.loadfixture()
+
+    @cache("fixture")
+    def loadfixture(self, path: Path) -> ValidationFixture:
+        # The tokenization depends on the vocabulary
+        scorer = self.retriever.scorer
+        path = path / scorer.vocab.__xpmidentifier__ / f"dlen-{scorer.dlen}"
+        if not (path / "info.json").is_file():
+            logging.info("Building the validation fixture in %s", path)
+            path.mkdir(parents=True, exist_ok=True)
+            ValidationFixture.build(
+                path, self.retriever.retriever, self.dataset, scorer.vocab, scorer.dlen
+            )
+        return ValidationFixture(path)
+
+    def rerank(self, scorer: LearnableScorer):
+        """Re-rank the first-stage results with the given scorer"""
+        retriever = self.retriever
+        for query in tqdm(list(self.dataset.topics.iter())):
+            scoredDocuments = retriever.retriever.retrieve(query.title)
+            scoredDocuments = scorer.rsv(query.title, scoredDocuments)
+            scoredDocuments.sort(reverse=True)
+            yield query.qid, scoredDocuments[: retriever.topk]
 
     def compute(self, state: ValidationState):
         # Evaluate
-        mean, _ = evaluate(None, self.retriever, self.dataset, self.metrics)
+        if self.fixture is not None:
+            results = self.fixture.rerank(state.ranker, self.retriever.topk)
+            mean, _ = evaluate_results(None, results, self.dataset, self.metrics)
+        elif isinstance(self.retriever, TwoStageRetriever):
+            # Use the state ranker (which might not be the validation scorer,
+            # e.g. when validating a checkpoint in another process)
+            results = self.rerank(state.ranker)
+            mean, _ = evaluate_results(None, results, self.dataset, self.metrics)
+        else:
+            mean, _ = evaluate(None, self.retriever, self.dataset, self.metrics)
 
         state.value = mean[self.metric]
         state.metrics = mean
 
 
+def _validation_worker(validation: Validation, setup, jobs, results):
+    """Validates the checkpoints sent by the learner (in a separate process)"""
+    setup()
+    validation.initialize()
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        epoch, path = job
+        try:
+            state = ValidationState()
+            state.load(Path(path), optimizer=False)
+            validation.compute(state)
+            results.put((epoch, state.value, state.metrics, None))
+        except Exception:
+            results.put((epoch, None, None, traceback.format_exc()))
+
+
+class AsyncValidation:
+    """Validates checkpoints in a worker process while training goes on"""
+
+    def __init__(self, validation: Validation, setup: Callable[[], None]):
+        context = multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+        self.pending = {}  # type: Dict[int, ValidationState]
+        self.process = context.Process(
+            target=_validation_worker,
+            args=(validation, setup, self.jobs, self.results),
+            daemon=True,
+        )
+        self.process.start()
+
+    def submit(self, state: ValidationState):
+        """Submit a (saved) state for validation"""
+        assert state.path is not None, "the state should be saved before validation"
+        self.pending[state.epoch] = state
+        self.jobs.put((state.epoch, str(state.path)))
+
+    def done(self, maxpending: int) -> Iterator[ValidationState]:
+        """Iterates over validated states, waiting until at most `maxpending`
+        states remain to be validated"""
+        while self.pending:
+            block = len(self.pending) > maxpending
+            try:
+                epoch, value, metrics, error = self.results.get(block=block)
+            except queue.Empty:
+                break
+
+            if error is not None:
+                raise RuntimeError(f"Validation of epoch {epoch} failed:\n{error}")
+
+            state = self.pending.pop(epoch)
+            state.value, state.metrics = value, metrics
+            yield state
+
+    def close(self):
+        self.jobs.put(None)
+        self.process.join()
+
+
+def _training_worker(
+    rank: int,
+    world_size: int,
+    init_method: str,
+    timeout: float,
+    random: Random,
+    scorer: LearnableScorer,
+    trainer: Trainer,
+    checkpointspath: Path,
+    max_epoch: int,
+    processes: int,
+    cpus: List[int],
+):
+    """Data-parallel training process (all ranks but the master)"""
+    trainer.device.setup(trainer.logger, rank, processes, cpus)
+    distributed = DistributedContext.init(rank, world_size, init_method, timeout)
+    scorer.initialize(random.state)
+    context = TrainContext(None, checkpointspath, distributed)
+    trainer.initialize(random.state, scorer, context)
+    for _ in trainer.iter_train(max_epoch):
+        pass
+    distributed.close()
+
+
 # Training
 @param("max_epoch", default=1000, help="Maximum training epoch")
 @param(
@@ -86,6 +344,26 @@ class Validation:
 @option(
     "checkpoint_interval", default=1, help="Number of epochs between each checkpoint"
 )
+@option(
+    "validation_delay",
+    default=0,
+    help="If strictly positive, checkpoints are validated in a separate process "
+    "while training goes on, and the validation can lag behind training by "
+    "at most this number of epochs (each epoch is then checkpointed until "
+    "validated, checkpoint_interval applying to the kept checkpoints)",
+)
+@option(
+    "processes",
+    default=1,
+    help="Number of data-parallel training processes (CPU, gloo backend): "
+    "the learner process validates and saves the checkpoints",
+)
+@option(
+    "distributed_timeout",
+    default=1800.0,
+    help="Maximum time (in seconds) a training process waits for the others "
+    "(e.g. for the learner process to validate and save a checkpoint)",
+)
 @pathoption("checkpointspath", "checkpoints")
 @pathoption("bestpath", "best")
 @pathoption("logpath", "runs")
@@ -108,13 +386,52 @@ class Learner(Scorer):
         self.only_cached = False
         self.bestpath.mkdir(exist_ok=True, parents=True)
 
+        # Setup threads and CPU affinity (the validation worker, if any,
+        # is the last process): the cores are computed before the master
+        # affinity is set, since the child processes inherit it
+        processes = self.processes + (1 if self.validation_delay > 0 else 0)
+        device = self.trainer.device
+        cpus = device.cpus()
+        device.setup(self.logger, 0, processes, cpus)
+
+        # Start the data-parallel training processes
+        distributed = None
+        if self.processes > 1:
+            self.logger.info("Starting %d training processes", self.processes)
+            distributed = DistributedContext.spawn(
+                self.processes,
+                self.distributed_timeout,
+                _training_worker,
+                self.random,
+                self.scorer,
+                self.trainer,
+                self.checkpointspath,
+                self.max_epoch,
+                processes,
+                cpus,
+            )
+
         # Initialize the scorer and trainer
         self.logger.info("Scorer initialization")
         self.scorer.initialize(self.random.state)
-        self.validation.initialize()
+        validator = None
+        if self.validation_delay > 0:
+            # The validation is initialized in the worker process
+            self.logger.info(
+                "Validating asynchronously (with at most %d epochs delay)",
+                self.validation_delay,
+            )
+            validator = AsyncValidation(
+                self.validation,
+                functools.partial(
+                    device.setup, self.logger, processes - 1, processes, cpus
+                ),
+            )
+        else:
+            self.validation.initialize()
 
         self.logger.info("Trainer initialization")
-        context = ValidationContext(self.logpath, self.checkpointspath)
+        context = ValidationContext(self.logpath, self.checkpointspath, distributed)
         self.trainer.initialize(self.random.state, self.scorer, context)
 
         # Top validation context
@@ -124,7 +441,62 @@ class Learner(Scorer):
         except Exception:
             top = None
 
+        # Last validated checkpoint kept (asynchronous validation)
+        kept = None
+
+        def validated(state: ValidationState):
+            """Process the validation results of a state"""
+            nonlocal top, kept
+
+            for metric in self.validation.metrics:
+                context.writer.add_scalar(
+                    f"val/{metric}", state.metrics[metric], state.epoch
+                )
+
+            # Mark the checkpoint as validated
+            if validator is not None:
+                state.saveinfo(state.path)
+
+            # Update the top validation
+            if state.epoch >= self.warmup:
+                if top is None or state.value > top.value:
+                    top = state
+                    if validator is None:
+                        context.copy(self.bestpath)
+                    else:
+                        context.copy(self.bestpath, state)
+
+            # Remove the validated checkpoints, except the last one saved
+            # every checkpoint_interval epochs
+            if validator is not None:
+                if state.epoch % self.checkpoint_interval == 0:
+                    if kept is not None:
+                        rmtree(kept)
+                    kept = state.path
+                else:
+                    rmtree(state.path)
+
+        if validator is not None:
+            # Checkpoints left by a previous run: the ones that were not
+            # validated are submitted, the validated ones removed (except the
+            # last one kept and the last checkpoint, from which training
+            # resumes)
+            paths = sorted(self.checkpointspath.glob(f"{TrainContext.PREFIX}*"))
+            for path in paths:
+                state = context.newstate()
+                state.load(path, onlyinfo=True)
+                if state.value is None:
+                    self.logger.info("Validating checkpoint of epoch %d", state.epoch)
+                    validator.submit(state)
+                elif state.epoch % self.checkpoint_interval == 0:
+                    if kept is not None:
+                        rmtree(kept)
+                    kept = path
+                elif path != paths[-1]:
+                    rmtree(path)
+
         self.logger.info("Starting to train")
+        lastvalidated = None
         for state in self.trainer.iter_train(self.max_epoch):
             # Report progress
             progress(state.epoch / self.max_epoch)
@@ -141,31 +513,31 @@ class Learner(Scorer):
 
             # Compute validation metrics
             if not state.cached:
-                # Compute validation metrics
-                self.validation.compute(state)
-                for metric in self.validation.metrics:
-                    context.writer.add_scalar(
-                        f"val/{metric}", state.metrics[metric], state.epoch
-                    )
+                if validator is None:
+                    # Compute validation metrics
+                    self.validation.compute(state)
 
-                # Save checkpoint if needed
-                if state.epoch % self.checkpoint_interval == 0:
-                    context.save_checkpoint()
+                    # Save checkpoint if needed
+                    if state.epoch % self.checkpoint_interval == 0:
+                        context.save_checkpoint()
 
-                # Update the top validation
-                if state.epoch >= self.warmup:
-                    if top is None or state.value > top.value:
-                        top = state
-                        context.copy(self.bestpath)
+                    validated(state)
+                    lastvalidated = state
+                else:
+                    # The worker validates from the checkpoint
+                    context.save_checkpoint(cleanup=False)
+                    validator.submit(state)
+                    for lastvalidated in validator.done(self.validation_delay):
+                        validated(lastvalidated)
 
             # Early stopping
-            if top is not None:
-                epochs_since_imp = context.epoch - top.epoch
+            if top is not None and lastvalidated is not None:
+                epochs_since_imp = lastvalidated.epoch - top.epoch
                 if self.early_stop > 0 and epochs_since_imp >= self.early_stop:
                     self.logger.warn(
                         "stopping after epoch {epoch} ({early_stop} epochs with no "
                         "improvement to validation metric)".format(
-                            **state.__dict__, **self.__dict__
+                            **lastvalidated.__dict__, **self.__dict__
                         )
                     )
                     break
@@ -179,9 +551,17 @@ class Learner(Scorer):
                 )
                 break
 
-        if not state.cached:
+        context.distributed.stop()
+
+        if validator is not None:
+            # Wait for the remaining validations
+            for lastvalidated in validator.done(0):
+                validated(lastvalidated)
+            validator.close()
+
+        if lastvalidated is not None:
             # Set the hyper-parameters
-            context.writer.add_hparams(self.__tags__, state.metrics)
+            context.writer.add_hparams(self.__tags__, lastvalidated.metrics)
 
         self.logger.info("top validation epoch={} {}".format(top.epoch, top.value))
 
@@ -192,7 +572,7 @@ class Learner(Scorer):
         if self._bestmodel is None:
             context = ValidationContext(self.logpath, self.checkpointspath)
             top = context.newstate()
-            top.load(self.bestpath, onlyinfo=False)
+            top.load(self.bestpath, optimizer=False)
             self._bestmodel = top.ranker
 
         return self._bestmodel
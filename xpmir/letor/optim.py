@@ -1,9 +1,28 @@
+from typing import List
 from experimaestro import config, param
 
 
+def sparse_parameters(module):
+    """Returns the (trainable) weights of the embeddings with sparse
+    gradients, indexed by their id"""
+    from torch.nn import Embedding
+
+    return {
+        id(m.weight): m.weight
+        for m in module.modules()
+        if isinstance(m, Embedding) and m.sparse and m.weight.requires_grad
+    }
+
+
 @config()
 class Optimizer:
-    pass
+    def create(self, module):
+        """Returns the optimizer for the parameters of the module"""
+        assert not sparse_parameters(module), (
+            f"{type(self).__name__} does not support sparse gradients "
+            "(e.g. sparse_grad=True): use SparseAdam"
+        )
+        return self(module.parameters())
 
 
 @param("lr", default=1e-3)
@@ -13,3 +32,48 @@ class Adam(Optimizer):
         from torch.optim import Adam
 
         return Adam(parameters, lr=self.lr)
+
+
+class MultipleOptimizer:
+    """Steps several torch optimizers at once"""
+
+    def __init__(self, *optimizers):
+        self.optimizers = [optimizer for optimizer in optimizers if optimizer]
+
+    @property
+    def param_groups(self):
+        return [group for o in self.optimizers for group in o.param_groups]
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, states: List):
+        for optimizer, state in zip(self.optimizers, states):
+            optimizer.load_state_dict(state)
+
+
+@param("lr", default=1e-3)
+@config()
+class SparseAdam(Optimizer):
+    """Adam where embeddings with sparse gradients (e.g. a word embedding
+    vocabulary with sparse_grad=True) are updated with torch SparseAdam, i.e.
+    only the rows used in the batch are updated"""
+
+    def create(self, module):
+        from torch.optim import Adam, SparseAdam
+
+        sparse = sparse_parameters(module)
+        dense = [p for p in module.parameters() if id(p) not in sparse]
+
+        return MultipleOptimizer(
+            Adam(dense, lr=self.lr) if dense else None,
+            SparseAdam(list(sparse.values()), lr=self.lr) if sparse else None,
+        )
@@ -1,11 +1,12 @@
-from typing import Any, Iterator, List, NamedTuple, Optional
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
 
 import numpy as np
 from datamaestro_text.data.ir import Adhoc
-from experimaestro import Annotated, Param, config, help, param, tqdm
+from datamaestro_text.data.ir.csv import TrainingTriplets
+from experimaestro import Annotated, Option, Param, config, help, param, tqdm
 from experimaestro.annotations import cache
 from xpmir.rankers import Retriever, ScoredDocument
-from xpmir.utils import EasyLogger
+from xpmir.utils import NOTIMER, EasyLogger
 
 
 class SamplerRecord:
@@ -71,6 +72,14 @@ class Records:
         self.documents = []
         self.relevances = []
 
+        # Filled by the scorer (or pre-tokenized)
+        self.queries_toks = None
+        self.docs_toks = None
+        self.queries_len = None
+        self.docs_len = None
+        self.queries_tokids = None
+        self.docs_tokids = None
+
     def add(self, record: SamplerRecord):
         self.queries.append(record.query)
         self.docids.append(record.docid)
@@ -83,6 +92,9 @@ class Records:
 class Sampler(EasyLogger):
     """"Abtract data sampler"""
 
+    # Set by the trainer to measure the time spent in the sampler
+    timer = NOTIMER
+
     def initialize(self, random: np.random.RandomState):
         self.random = random
 
@@ -90,6 +102,17 @@ class Sampler(EasyLogger):
         """Returns an iterator over records (query, document, relevance)"""
         raise NotImplementedError()
 
+    def state_dict(self) -> Dict[str, Any]:
+        """Returns the sampler state (so that sampling can be resumed)
+
+        Samplers reading records sequentially should add their position
+        """
+        return {"random": self.random.get_state()}
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        """Restores the sampler state"""
+        self.random.set_state(state["random"])
+
 
 # @param("dataset", type=Adhoc, help="The topics and assessments")
 # @param("retriever", type=Retriever, help="The retriever")
@@ -102,11 +125,14 @@ class ModelBasedSampler(Sampler):
     relevant_ratio: The sampling ratio of relevant to non relevant
     dataset: The topics and assessments
     retriever: The document retriever
+    text: Whether to fetch the document text (not needed when the scorer
+        uses pre-tokenized documents)
     """
 
     relevant_ratio: Param[float] = 0.5
     dataset: Param[Adhoc]
     retriever: Param[Retriever]
+    text: Option[bool] = True
 
     def initialize(self, random):
         super().initialize(random)
@@ -189,8 +215,9 @@ class ModelBasedSampler(Sampler):
         return pos_records, neg_records
 
     def prepare(self, record: SamplerRecord):
-        if record.document is None:
-            record.document = self.index.document_text(record.docid)
+        if record.document is None and self.text:
+            with self.timer("document_text"):
+                record.document = self.index.document_text(record.docid)
         return record
 
     def record_iter(self) -> Iterator[SamplerRecord]:
@@ -205,4 +232,51 @@ class ModelBasedSampler(Sampler):
 
 @config()
 class TripletBasedSampler(Sampler):
-    """Sampler based on a triplet file"""
+    """Sampler based on a triplet file
+
+    Each line (query, relevant and non relevant document texts) gives a
+    relevant and a non relevant record; the file is read sequentially (and
+    again when its end is reached).
+
+    Attributes:
+        triplets: The training triplets (full text)
+    """
+
+    triplets: Param[TrainingTriplets]
+
+    # Offset (in bytes) of the current line, and number of its records that
+    # have been sampled
+    _position = (0, 0)
+
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        state["position"] = self._position
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        super().load_state_dict(state)
+        self._position = tuple(state["position"])
+
+    def record_iter(self) -> Iterator[SamplerRecord]:
+        with self.triplets.path.open("rb") as fp:
+            offset, skip = self._position
+            fp.seek(offset)
+            while True:
+                line = fp.readline()
+                if not line:
+                    assert offset > 0, f"No triplets in {self.triplets.path}"
+                    offset, skip = 0, 0
+                    fp.seek(0)
+                    continue
+
+                query, relevant, nonrelevant = (
+                    line.decode("utf-8").rstrip("\r\n").split(self.triplets.separator)
+                )
+                records = (
+                    SamplerRecord(query, None, relevant, 0.0, 1),
+                    SamplerRecord(query, None, nonrelevant, 0.0, 0),
+                )
+                for ix in range(skip, len(records)):
+                    self._position = (offset, ix + 1)
+                    yield records[ix]
+                offset, skip = fp.tell(), 0
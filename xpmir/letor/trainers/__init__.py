@@ -1,17 +1,20 @@
 import json
+import pickle
 from pathlib import Path
 from shutil import rmtree
-from typing import Dict
+from typing import Dict, Optional
 from experimaestro import Option, config, help, Param
 from experimaestro import tqdm
 from experimaestro.utils import cleanupdir
+import numpy as np
 import torch
 from torch.utils.tensorboard import SummaryWriter
 from typing_extensions import Annotated
 from xpmir.letor.samplers import Sampler
-from xpmir.utils import EasyLogger, easylog
+from xpmir.utils import EasyLogger, PhaseTimer, easylog
 from xpmir.letor.optim import Adam, Optimizer
-from xpmir.letor import Device, DEFAULT_DEVICE
+from xpmir.letor import Device, DEFAULT_DEVICE, load_checkpoint
+from xpmir.letor.distributed import DistributedContext
 
 
 class TrainState:
@@ -22,6 +25,10 @@ class TrainState:
         self.ranker = state.ranker if state else None
         self.optimizer = state.optimizer if state else None
 
+        # The trainer (whose state is saved) and the loaded trainer state
+        self.trainer = state.trainer if state else None
+        self.trainer_state = None
+
         # The epoch
         self.epoch = state.epoch if state else 0
 
@@ -37,9 +44,7 @@ class TrainState:
     def save(self, path):
         """Save the state"""
         cleanupdir(path)
-
-        with (path / "info.json").open("wt") as fp:
-            json.dump(self.__getstate__(), fp)
+        self.saveinfo(path)
 
         with (path / "ranker.pth").open("wb") as fp:
             torch.save(self.ranker, fp)
@@ -47,15 +52,34 @@ class TrainState:
         with (path / "optimizer.pth").open("wb") as fp:
             torch.save(self.optimizer, fp)
 
+        if self.trainer is not None:
+            # Pickled (the sampler state can hold any python object, which
+            # torch.load does not load by default)
+            with (path / "trainer.pkl").open("wb") as fp:
+                pickle.dump(self.trainer.state_dict(), fp)
+
         self.path = path
 
-    def load(self, path, onlyinfo=False):
+    def saveinfo(self, path):
+        """Save the state information (but not the model and optimizer)"""
+        with (path / "info.json").open("wt") as fp:
+            json.dump(self.__getstate__(), fp)
+
+    def load(self, path, onlyinfo=False, optimizer=True):
+        """Loads the state (only the information if onlyinfo is true, and
+        without the optimizer if optimizer is false)"""
         if not onlyinfo:
             with (path / "ranker.pth").open("rb") as fp:
-                self.ranker = torch.load(fp)
+                self.ranker = load_checkpoint(fp)
+
+            if optimizer:
+                with (path / "optimizer.pth").open("rb") as fp:
+                    self.optimizer = load_checkpoint(fp)
 
-            with (path / "optimizer.pth").open("rb") as fp:
-                self.optimizer = torch.load(fp)
+            # Might not exist for older checkpoints
+            if (path / "trainer.pkl").is_file():
+                with (path / "trainer.pkl").open("rb") as fp:
+                    self.trainer_state = pickle.load(fp)
 
         with (path / "info.json").open("rt") as fp:
             self.__dict__.update(json.load(fp))
@@ -70,11 +94,14 @@ class TrainContext(EasyLogger):
     PREFIX = "epoch-"
     STATETYPE = TrainState
 
-    def __init__(self, logpath: Path, path: Path):
+    def __init__(
+        self, logpath: Path, path: Path, distributed: DistributedContext = None
+    ):
         self.path = path
         self.state = self.newstate()
         self.logpath = logpath
         self._writer = None
+        self.distributed = distributed or DistributedContext()
 
     @property
     def writer(self):
@@ -99,6 +126,11 @@ class TrainContext(EasyLogger):
         self.state = self.newstate(self.oldstate)
         self.state.epoch += 1
 
+    def load_checkpoint(self, epoch: int):
+        """Load the checkpoint of a given epoch"""
+        self.state = self.newstate()
+        self.state.load(self.path / f"{TrainContext.PREFIX}{epoch:08d}")
+
     def load_bestcheckpoint(self, target):
         # Find all the potential epochs
         epochs = []
@@ -124,7 +156,12 @@ class TrainContext(EasyLogger):
 
         return False
 
-    def save_checkpoint(self):
+    def save_checkpoint(self, cleanup=True):
+        """Save the current state
+
+        Arguments:
+            cleanup: Whether to remove the previous checkpoint
+        """
         # Serialize
         path = self.path / f"{TrainContext.PREFIX}{self.epoch:08d}"
         if self.state.path is not None:
@@ -135,7 +172,7 @@ class TrainContext(EasyLogger):
         self.state.save(path)
 
         # Cleanup if needed
-        if self.oldstate and self.oldstate.path:
+        if cleanup and self.oldstate and self.oldstate.path:
             rmtree(self.oldstate.path)
             self.oldstate = None
 
@@ -157,6 +194,23 @@ class Trainer(EasyLogger):
         self.writer = None
         self.sampler
 
+        # Measures the time spent in each training phase
+        self.timer = PhaseTimer()
+        self.sampler.timer = self.timer
+
+        distributed = context.distributed
+        self._rank_states = None
+        if distributed.enabled:
+            # Each process samples its own stream of records
+            self.random = np.random.RandomState(
+                random.randint((2 ** 31) - 1) + distributed.rank
+            )
+            self.logger.info(
+                "Data-parallel training: process %d/%d",
+                distributed.rank + 1,
+                distributed.world_size,
+            )
+
         if self.grad_acc_batch > 0:
             assert (
                 self.batch_size % self.grad_acc_batch == 0
@@ -176,58 +230,162 @@ class Trainer(EasyLogger):
 
     def iter_train(self, loadepoch: int):
         context = self.context
+        distributed = context.distributed
+
+        if distributed.is_master:
+            loaded = self.context.load_bestcheckpoint(loadepoch)
+        if distributed.enabled:
+            # Workers load the checkpoint chosen by the master
+            epoch = distributed.broadcast(
+                context.epoch if distributed.is_master and loaded else -1
+            )
+            if not distributed.is_master and epoch >= 0:
+                context.load_checkpoint(epoch)
+            loaded = epoch >= 0
 
-        if not self.context.load_bestcheckpoint(loadepoch):
-            context.state.optimizer = self.optimizer(self.ranker.parameters())
+        if not loaded:
+            distributed.broadcast_parameters(self.ranker.parameters())
+            context.state.optimizer = self.optimizer.create(self.ranker)
             context.state.ranker = self.ranker
         else:
+            # Train the loaded model
+            self.ranker = context.state.ranker
+            if context.state.trainer_state is not None:
+                self.load_state_dict(context.state.trainer_state)
+            else:
+                self.logger.warning(
+                    "No trainer state in checkpoint: sampling will not be resumed"
+                )
             yield context.state
 
-        context.state.ranker.to(self.device)
-        b_count = self.batches_per_epoch * self.num_microbatches * self.batch_size
+        context.state.trainer = self
 
-        while True:
+        context.state.ranker.to(self.device)
+        if hasattr(context.state.ranker, "timer"):
+            context.state.ranker.timer = self.timer
+        while distributed.proceed():
             context.nextepoch()
 
             # forward to previous versions (if needed)
             context.state.ranker.train()
+            self.timer.reset()
 
             with tqdm(
-                leave=False, total=b_count, ncols=100, desc=f"train {context.epoch}"
+                leave=False,
+                total=self.records_per_epoch(),
+                ncols=100,
+                desc=f"train {context.epoch}",
             ) as pbar:
                 total_loss = 0
                 for b in range(self.batches_per_epoch):
                     for _ in range(self.num_microbatches):
                         loss = self.train_batch()
-                        loss.backward()
+                        with self.timer("backward"):
+                            loss.backward()
                         total_loss += loss.item()
-                        pbar.update(self.batch_size)
-
-                    context.state.optimizer.step()
-                    context.state.optimizer.zero_grad()
-
-            self.context.writer.add_scalar(
-                "train/loss",
-                total_loss / (self.num_microbatches * self.batches_per_epoch),
-                self.context.epoch,
-            )
+                        pbar.update(self.batch_records())
+
+                    with self.timer("optimizer"):
+                        distributed.all_reduce_gradients(
+                            context.state.ranker.parameters()
+                        )
+                        context.state.optimizer.step()
+                        context.state.optimizer.zero_grad()
+
+            total_loss = distributed.mean(total_loss)
+            if distributed.is_master:
+                self.context.writer.add_scalar(
+                    "train/loss",
+                    total_loss / (self.num_microbatches * self.batches_per_epoch),
+                    self.context.epoch,
+                )
+                self.write_timings()
+
+            if distributed.enabled:
+                # The master saves the state of all the processes
+                self._rank_states = distributed.all_gather(self.local_state_dict())
 
             yield context.state
 
     def train_batch(self):
         raise NotImplementedError()
 
-    def fast_forward(self, record_count):
-        raise NotImplementedError()
+    def batch_records(self) -> int:
+        """Number of records of the last batch (from `train_batch`)"""
+        return self.batch_size
+
+    def records_per_epoch(self) -> Optional[int]:
+        """Number of records of an epoch (None if unknown)"""
+        return self.batches_per_epoch * self.num_microbatches * self.batch_size
+
+    def write_timings(self):
+        """Reports the epoch timings to tensorboard and to the timings.jsonl
+        file (next to the checkpoints)"""
+        epoch = self.context.epoch
+        report = self.timer.report()
+        writer = self.context.writer
+        for phase, durations in self.timer.durations.items():
+            writer.add_scalar(
+                f"timings/{phase}", report["phases"][phase]["total"], epoch
+            )
+            writer.add_histogram(f"timings/{phase}", np.array(durations), epoch)
+        for key in ("records", "tokens"):
+            if key in report:
+                writer.add_scalar(
+                    f"throughput/{key}_per_sec", report[f"{key}_per_sec"], epoch
+                )
+
+        # Compiled vs eager forward (on the same batches)
+        phases = report["phases"]
+        if "eager" in phases and "compiled" in phases:
+            report["compile_speedup"] = phases["eager"]["total"] / max(
+                phases["compiled"]["total"], 1e-9
+            )
+            writer.add_scalar(
+                "timings/compile_speedup", report["compile_speedup"], epoch
+            )
 
-    def _fast_forward(self, train_it, fields, record_count):
-        # Since the train_it holds a refernece to fields, we can greatly speed up the "fast forward"
-        # process by temporarily clearing the requested fields (meaning that the train iterator
-        # should simply find the records/pairs to return, but yield an empty payload).
-        orig_fields = set(fields)
-        try:
-            fields.clear()
-            for _ in zip(range(record_count), train_it):
-                pass
-        finally:
-            fields.update(orig_fields)
+        self.context.path.mkdir(parents=True, exist_ok=True)
+        with (self.context.path / "timings.jsonl").open("at") as fp:
+            json.dump({"epoch": epoch, **report}, fp)
+            fp.write("\n")
+
+    def state_dict(self):
+        """Returns the state needed to resume training where it stopped
+        (sampler and random number generators)"""
+        state = self.local_state_dict()
+        if self._rank_states is not None:
+            state = dict(state, ranks=[state] + self._rank_states[1:])
+        return state
+
+    def local_state_dict(self):
+        """Returns the state of this process"""
+        state = {
+            "sampler": self.sampler.state_dict(),
+            "torch_rng": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            state["cuda_rng"] = torch.cuda.get_rng_state_all()
+        return state
+
+    def load_state_dict(self, state):
+        """Restores the state saved by `state_dict`"""
+        distributed = self.context.distributed
+        if distributed.enabled:
+            ranks = state.get("ranks", [state])
+            if len(ranks) != distributed.world_size:
+                self.logger.warning(
+                    "Checkpoint saved with %d processes (now %d)",
+                    len(ranks),
+                    distributed.world_size,
+                )
+            state = ranks[distributed.rank % len(ranks)]
+
+        self.load_local_state_dict(state)
+
+    def load_local_state_dict(self, state):
+        """Restores the state of this process"""
+        self.sampler.load_state_dict(state["sampler"])
+        torch.set_rng_state(state["torch_rng"])
+        if "cuda_rng" in state and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(state["cuda_rng"])
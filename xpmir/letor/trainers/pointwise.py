@@ -1,24 +1,56 @@
 import sys
-from typing import List
+from typing import List, Optional
 import numpy as np
 import torch
 import torch.nn.functional as F
-from experimaestro import param, config
-from xpmir.letor.samplers import Records
+from experimaestro import param, config, Param
+from xpmir.letor.samplers import Records, SamplerRecord
 from xpmir.letor.trainers import Trainer
 
 
 @param("lossfn", default="mse")
 @config()
 class PointwiseTrainer(Trainer):
+    """Pointwise trainer
+
+    Attributes:
+        token_budget: If strictly positive, records are bucketed by (tokenized)
+            document length, and each batch holds as many records as possible
+            while keeping its number of padded document tokens below this
+            budget. The loss is normalized so that each record has the same
+            weight within an optimization step.
+        bucket_buffer: Number of records that are bucketed together (when
+            using a token budget)
+    """
+
+    token_budget: Param[int] = 0
+    bucket_buffer: Param[int] = 1024
+
+    def __validate__(self):
+        if self.token_budget > 0:
+            microbatches = (
+                self.batch_size // self.grad_acc_batch if self.grad_acc_batch > 0 else 1
+            )
+            assert (
+                self.bucket_buffer >= microbatches
+            ), f"The bucket buffer ({self.bucket_buffer}) cannot fill the {microbatches} micro-batches of a step"
+
     def initialize(self, random: np.random.RandomState, ranker, context):
         super().initialize(random, ranker, context)
 
         self.sampler.initialize(self.random)
 
-        self.random = random
         self.train_iter_core = self.sampler.record_iter()
-        self.train_iter = self.iter_batches(self.train_iter_core)
+        if self.token_budget > 0:
+            assert hasattr(
+                self.ranker, "vocab"
+            ), "A token budget can only be used with a scorer using a vocabulary"
+            self._buffer_state = None
+            self._buffer_consumed = 0
+            self._step_batches = []
+            self.train_iter = self.iter_budget_steps(self.train_iter_core)
+        else:
+            self.train_iter = self.iter_batches(self.train_iter_core)
 
     def iter_batches(self, it):
         while True:  # breaks on StopIteration
@@ -28,19 +60,138 @@ class PointwiseTrainer(Trainer):
 
             yield batch
 
+    def bucket(self, records: List[SamplerRecord]) -> List[Records]:
+        """Group records by document length into batches under the token budget"""
+        dlen = self.ranker.dlen
+        with self.timer("tokenize"):
+            toks, tokids, lens = self.ranker.tokenize_documents(
+                [record.docid for record in records],
+                [record.document for record in records],
+            )
+        lens = np.minimum(lens, dlen)
+
+        # Greedily fill batches with records sorted by length
+        batches, current = [], []
+        for ix in np.argsort(lens, kind="stable"):
+            if current and (len(current) + 1) * max(lens[ix], 1) > self.token_budget:
+                batches.append(current)
+                current = []
+            current.append(ix)
+        if current:
+            batches.append(current)
+
+        result = []
+        for indices in batches:
+            batch = Records()
+            for ix in indices:
+                batch.add(records[ix])
+            maxlen = max(lens[ix] for ix in indices)
+            batch.docs_toks = [toks[ix] for ix in indices] if toks else None
+            batch.docs_tokids = tokids[indices, :maxlen]
+            batch.docs_len = [int(lens[ix]) for ix in indices]
+            result.append(batch)
+        return result
+
+    def iter_budget_steps(self, it):
+        """Iterates over optimization steps (lists of batches) under the token
+        budget
+
+        Batches are formed from a buffer of records, and yielded by groups of
+        micro-batches (in random order). To resume deterministically, the
+        sampler state at the start of the buffer is stored along with the
+        number of steps already consumed from the buffer.
+        """
+        while True:
+            state = self.sampler.state_dict()
+            records = [record for _, record in zip(range(self.bucket_buffer), it)]
+            if not records:
+                return
+
+            batches = self.bucket(records)
+            self.random.shuffle(batches)
+
+            # Drops the last step if there are not enough batches
+            steps = [
+                batches[ix : ix + self.num_microbatches]
+                for ix in range(
+                    0, len(batches) - self.num_microbatches + 1, self.num_microbatches
+                )
+            ]
+            if not steps:
+                if len(records) < self.bucket_buffer:
+                    # End of the records
+                    return
+                raise RuntimeError(
+                    f"The bucket buffer ({len(records)} records) only yields "
+                    f"{len(batches)} batches (token budget {self.token_budget}) "
+                    f"for {self.num_microbatches} micro-batches per step: "
+                    "increase bucket_buffer or decrease token_budget"
+                )
+
+            skip, self._buffer_consumed = self._buffer_consumed, 0
+            self._buffer_state = state
+            for step in steps[skip:]:
+                self._buffer_consumed += 1
+                yield step
+            self._buffer_consumed = 0
+
+    def local_state_dict(self):
+        state = super().local_state_dict()
+        if self.token_budget > 0 and self._buffer_state is not None:
+            # Resume from the start of the current buffer
+            state["sampler"] = self._buffer_state
+            state["buffer_consumed"] = self._buffer_consumed
+        return state
+
+    def load_local_state_dict(self, state):
+        super().load_local_state_dict(state)
+        if self.token_budget > 0:
+            self._buffer_consumed = state.get("buffer_consumed", 0)
+
     def train_batch(self):
         # Get the next batch
-        batch = next(self.train_iter)
+        with self.timer("sampling"):
+            if self.token_budget > 0:
+                if not self._step_batches:
+                    self._step_batches = list(next(self.train_iter))
+                    self._step_records = sum(len(b.docids) for b in self._step_batches)
+                batch = self._step_batches.pop(0)
+                self._batch_records = len(batch.docids)
+            else:
+                batch = next(self.train_iter)
 
+        if hasattr(self.ranker, "tokenize"):
+            with self.timer("tokenize"):
+                self.ranker.tokenize(batch)
+            self.timer.add(tokens=sum(batch.queries_len) + sum(batch.docs_len))
+        self.timer.add(records=len(batch.docids))
+
+        with self.timer("forward"):
+            loss = self.compute_loss(batch)
+
+        return loss
+
+    def batch_records(self) -> int:
+        if self.token_budget > 0:
+            return self._batch_records
+        return super().batch_records()
+
+    def records_per_epoch(self) -> Optional[int]:
+        if self.token_budget > 0:
+            # Depends on the document lengths
+            return None
+        return super().records_per_epoch()
+
+    def compute_loss(self, batch: Records):
         rel_scores = self.ranker(batch)
         if torch.isnan(rel_scores).any() or torch.isinf(rel_scores).any():
             self.logger.error("nan or inf relevance score detected. Aborting.")
             sys.exit(1)
 
         target_relscores = torch.FloatTensor(batch.relevances)
-        target_relscores[
-            target_relscores == -999.0
-        ] = 0.0  # replace -999 with non-relevant score
+        target_relscores[target_relscores == -999.0] = (
+            0.0  # replace -999 with non-relevant score
+        )
 
         # Apply the loss
         if self.lossfn == "mse":
@@ -83,7 +234,11 @@ class PointwiseTrainer(Trainer):
         else:
             raise ValueError(f"unknown lossfn `{self.lossfn}`")
 
-        return loss
+        if self.token_budget > 0:
+            # Each record of the step has the same weight (as with fixed-size
+            # micro-batches)
+            loss = loss * (
+                len(batch.docids) * self.num_microbatches / self._step_records
+            )
 
-    def fast_forward(self, record_count):
-        self._fast_forward(self.train_iter_core, self.iter_fields, record_count)
+        return loss
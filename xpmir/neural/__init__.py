@@ -1,11 +1,13 @@
-from typing import List
+from typing import List, Optional
 import torch
 import torch.nn as nn
 
-from experimaestro import config, Param
+from experimaestro import config, Option, Param
 from xpmir.letor.samplers import Records, SamplerRecord
 from xpmir.rankers import LearnableScorer, ScoredDocument
+from xpmir.utils import NOTIMER
 from xpmir.vocab import Vocab
+from xpmir.vocab.collection import TokenizedCollection
 
 
 @config()
@@ -19,12 +21,50 @@ class InteractionScorer(LearnableScorer, nn.Module):
         add_runscore:
             Whether the base predictor score should be added to the
             model score
+        simmat_dtype: Type of the similarity matrices (float32, float16 or
+            bfloat16)
+        simmat_budget: Memory budget (in MB) for the intermediate results when
+            computing the similarity matrices -- if positive, the matrices are
+            computed by chunks (the matrices themselves are not included)
+        simmat_cache: Number of (normalized) document representations
+            kept in memory when the vocabulary is static
+        tokenized: Pre-tokenized documents (the document text is then not
+            needed)
+        use_compile: Whether to compile `_forward` with torch.compile (eager
+            mode is used if torch.compile is not available or fails)
+        compile_bucket: When compiling, queries and documents are padded to a
+            multiple of this number of tokens (capped at qlen and dlen) so that
+            only a few shapes are compiled
+        compile_benchmark: When compiling, every compile_benchmark batches,
+            the batch is also computed (without gradient) in eager and
+            compiled mode to measure the speed-up (0 to disable)
     """
 
     vocab: Param[Vocab]
     qlen: Param[int] = 20
     dlen: Param[int] = 2000
     add_runscore: Param[bool] = False
+    simmat_dtype: Param[str] = "float32"
+    simmat_budget: Option[int] = 0
+    simmat_cache: Option[int] = 0
+    tokenized: Option[Optional[TokenizedCollection]] = None
+    use_compile: Option[bool] = False
+    compile_bucket: Option[int] = 64
+    compile_benchmark: Option[int] = 0
+
+    # Set by the trainer to measure the time spent in the scorer
+    timer = NOTIMER
+
+    _compiled = None
+    _calls = 0
+    _benchmarks = 0
+
+    def __getstate__(self):
+        return {
+            key: value
+            for key, value in self.__dict__.items()
+            if key not in ("_compiled", "timer")
+        }
 
     def initialize(self, random):
         self.random = random
@@ -36,12 +76,21 @@ class InteractionScorer(LearnableScorer, nn.Module):
         if self.add_runscore:
             self.runscore_alpha = torch.nn.Parameter(torch.full((1,), -1.0))
         self.vocab.initialize()
+        if self.tokenized is not None:
+            assert (
+                self.tokenized.vocab.__xpmidentifier__ == self.vocab.__xpmidentifier__
+            ), "The documents were tokenized with another vocabulary"
+
+    def initialize_inputs(self):
+        """Initializes only what is needed to compute the model inputs (see
+        `export_inputs`), e.g. when the model itself was exported"""
+        self.vocab.initialize_tokenizer()
 
     def rsv(self, query: str, documents: List[ScoredDocument]) -> List[ScoredDocument]:
         # Prepare the inputs and call the model
         inputs = Records()
         for doc in documents:
-            assert doc.content is not None
+            assert doc.content is not None or self.tokenized is not None
             inputs.add(SamplerRecord(query, doc.docid, doc.content, doc.score, None))
 
         with torch.no_grad():
@@ -54,7 +103,22 @@ class InteractionScorer(LearnableScorer, nn.Module):
 
         return scoredDocuments
 
+    def interaction_matrix(self):
+        """Returns the module computing the similarity matrices"""
+        from xpmir.neural.modules import InteractionMatrix
+
+        return InteractionMatrix(
+            budget=self.simmat_budget * 2 ** 20,
+            dtype=getattr(torch, self.simmat_dtype),
+            cache=self.simmat_cache,
+        )
+
     def __validate__(self):
+        assert self.simmat_dtype in (
+            "float32",
+            "float16",
+            "bfloat16",
+        ), f"Unsupported similarity matrix type {self.simmat_dtype}"
         assert (
             self.dlen < self.vocab.maxtokens()
         ), f"The maximum document length ({self.dlen}) should be less that what the vocab can process ({self.vocab.maxtokens})"
@@ -62,9 +126,38 @@ class InteractionScorer(LearnableScorer, nn.Module):
             self.qlen < self.vocab.maxtokens()
         ), f"The maximum query length ({self.qlen}) should be less that what the vocab can process ({self.vocab.maxtokens})"
 
+    def tokenize(self, inputs: Records):
+        """Tokenize the queries and documents of the records (unless this
+        has already been done, e.g. for pre-tokenized records)"""
+        if inputs.queries_tokids is None:
+            (
+                inputs.queries_toks,
+                inputs.queries_tokids,
+                inputs.queries_len,
+            ) = self.vocab.batch_tokenize(inputs.queries, maxlen=self.qlen)
+        if inputs.docs_tokids is None:
+            (
+                inputs.docs_toks,
+                inputs.docs_tokids,
+                inputs.docs_len,
+            ) = self.tokenize_documents(inputs.docids, inputs.documents)
+
+    def tokenize_documents(self, docids: List[str], documents: List[str]):
+        """Returns the tokens (None if pre-tokenized), the token IDs and the
+        lengths of the documents"""
+        if self.tokenized is not None:
+            tokids, lens = self.tokenized.batch(docids, maxlen=self.dlen)
+            return None, tokids, lens
+        return self.vocab.batch_tokenize(documents, maxlen=self.dlen)
+
     def forward(self, inputs: Records):
+        self.tokenize(inputs)
+
         # Forward to model
-        result = self._forward(inputs)
+        if self.use_compile:
+            result = self.compiled_forward(inputs)
+        else:
+            result = self._forward(inputs)
 
         if len(result.shape) == 2 and result.shape[1] == 1:
             result = result.reshape(result.shape[0])
@@ -79,6 +172,91 @@ class InteractionScorer(LearnableScorer, nn.Module):
     def _forward(self, inputs: Records):
         raise NotImplementedError
 
+    def bucket(self, inputs: Records):
+        """Pads the query and document token IDs to a multiple of
+        compile_bucket, capped at qlen and dlen (padding tokens are masked by
+        the models)"""
+
+        def pad(tokids, maxlen):
+            length = tokids.shape[1]
+            bucket = max(self.compile_bucket, 1)
+            padded = max(min(-(-length // bucket) * bucket, maxlen), length)
+            if padded > length:
+                return nn.functional.pad(tokids, (0, padded - length), value=-1)
+            return tokids
+
+        inputs.queries_tokids = pad(inputs.queries_tokids, self.qlen)
+        inputs.docs_tokids = pad(inputs.docs_tokids, self.dlen)
+
+    def compiled_forward(self, inputs: Records):
+        """Computes `_forward` with torch.compile (on bucketed inputs)"""
+        if self._compiled is None:
+            if hasattr(torch, "compile"):
+                # The batch size varies (e.g. last batch, token budget)
+                self._compiled = torch.compile(self._forward, dynamic=True)
+            else:
+                self.logger.warning("torch.compile is not available: using eager mode")
+                self._compiled = self._forward
+
+        self.bucket(inputs)
+        self._calls += 1
+        benchmark = (
+            self.compile_benchmark > 0
+            and self._calls % self.compile_benchmark == 0
+            and self._compiled != self._forward
+        )
+        try:
+            if benchmark:
+                self.benchmark(inputs)
+            return self._compiled(inputs)
+        except Exception:
+            if self._compiled == self._forward:
+                raise
+            self.logger.exception("Compilation failed: using eager mode")
+            self._compiled = self._forward
+            return self._forward(inputs)
+
+    def benchmark(self, inputs: Records):
+        """Times the eager and compiled forward passes on a batch
+
+        Both passes are computed without gradient and without consuming the
+        random state (e.g. dropout); which one runs first alternates between
+        benchmarks, and the first benchmark (compilation) is not timed
+        """
+        self._benchmarks += 1
+        timer = self.timer if self._benchmarks > 1 else NOTIMER
+        passes = [("compiled", self._compiled), ("eager", self._forward)]
+        if self._benchmarks % 2:
+            passes.reverse()
+        with torch.no_grad(), torch.random.fork_rng():
+            for name, forward in passes:
+                with timer(name):
+                    forward(inputs)
+
+    def export_names(self) -> List[str]:
+        """Names of the tensors given to the exported model"""
+        return ["queries_tokids", "queries_len", "docs_tokids", "docs_len", "scores"]
+
+    def export_inputs(self, inputs: Records) -> List[torch.Tensor]:
+        """Returns the tensors given to the exported model, i.e. everything
+        that is computed in python (tokenization, etc.)"""
+        self.tokenize(inputs)
+        return [
+            inputs.queries_tokids,
+            torch.as_tensor(inputs.queries_len, dtype=torch.long),
+            inputs.docs_tokids,
+            torch.as_tensor(inputs.docs_len, dtype=torch.long),
+            torch.as_tensor(inputs.scores, dtype=torch.float),
+        ]
+
+    def export_forward(self, *tensors: torch.Tensor):
+        """Computes the scores from the tensors returned by `export_inputs`
+        (this is what gets traced when exporting the model)"""
+        inputs = Records()
+        for name, tensor in zip(self.export_names(), tensors):
+            setattr(inputs, name, tensor)
+        return self(inputs)
+
     def save(self, path):
         state = self.state_dict(keep_vars=True)
         for key in list(state):
@@ -13,41 +13,39 @@ class CountHistogram(nn.Module):
     def forward(self, simmat, dlens, dtoks, qtoks):
         BATCH, CHANNELS, QLEN, DLEN = simmat.shape
 
+        # Counts are (at least) in single precision
+        dtype = torch.promote_types(simmat.dtype, torch.float)
+
         # +1e-5 to nudge scores of 1 to above threshold
-        bins = ((simmat + 1.00001) / 2.0 * (self.nbins - 1)).int()
-        weights = (
-            (dtoks != -1).reshape(BATCH, 1, DLEN).expand(BATCH, QLEN, DLEN)
-            * (qtoks != -1).reshape(BATCH, QLEN, 1).expand(BATCH, QLEN, DLEN)
-        ).float()
-        # apparently no way to batch this... https://discuss.pytorch.org/t/histogram-function-in-pytorch/5350
-        bins, weights = (
-            bins.cpu(),
-            weights.cpu(),
-        )  # WARNING: this line (and the similar line below) improve performance tenfold when on GPU
-        histogram = []
-        for superbins, w in zip(bins, weights):
-            result = []
-            for b in superbins:
-                result.append(
-                    torch.stack(
-                        [torch.bincount(q, x, self.nbins) for q, x in zip(b, w)], dim=0
-                    )
-                )
-            result = torch.stack(result, dim=0)
-            histogram.append(result)
-        histogram = torch.stack(histogram, dim=0)
-        histogram = histogram.to(
-            simmat.device
-        )  # WARNING: this line (and the similar line above) improve performance tenfold when on GPU
-        return histogram
+        bins = simmat.to(dtype) + 1.00001
+        bins = bins.div_(2.0).mul_(self.nbins - 1).long().clamp_(0, self.nbins - 1)
+
+        # Padding goes to an extra bin (removed afterwards), and all the
+        # histograms are computed at once
+        padding = (dtoks == -1).reshape(BATCH, 1, 1, DLEN) | (qtoks == -1).reshape(
+            BATCH, 1, QLEN, 1
+        )
+        bins.masked_fill_(padding, self.nbins)
+        ones = torch.ones((), dtype=dtype, device=simmat.device)
+        histogram = torch.zeros(
+            BATCH,
+            CHANNELS,
+            QLEN,
+            self.nbins + 1,
+            dtype=dtype,
+            device=simmat.device,
+        )
+        histogram.scatter_add_(3, bins, ones.expand(BATCH, CHANNELS, QLEN, DLEN))
+        return histogram[..., : self.nbins]
 
 
 @config()
 class NormalizedHistogram(CountHistogram):
     def forward(self, simmat, dlens, dtoks, qtoks):
         result = super().forward(simmat, dlens, dtoks, qtoks)
-        BATCH, QLEN, _ = simmat.shape
-        return result / dlens.reshape(BATCH, 1).expand(BATCH, QLEN)
+        BATCH = simmat.shape[0]
+        dlens = torch.as_tensor(dlens, dtype=result.dtype, device=result.device)
+        return result / dlens.reshape(BATCH, 1, 1, 1)
 
 
 @config()
@@ -88,33 +86,92 @@ class Drmm(InteractionScorer):
                 "because the histogram is not differentiable. An exception might be if "
                 "the gradient is proped back by another means, e.g. BERT [CLS] token."
             )
-        self.simmat = modules.InteractionMatrix()
+        self.simmat = self.interaction_matrix()
         channels = self.vocab.emb_views()
         self.hidden_1 = nn.Linear(self.hist.nbins * channels, self.hidden)
         self.hidden_2 = nn.Linear(self.hidden, 1)
         self.needs_idf = self.combine == "idf"
+        self._idf = None
         self.combine = {"idf": IdfCombination, "sum": SumCombination}[self.combine]()
 
+    def initialize_inputs(self):
+        super().initialize_inputs()
+        self.needs_idf = self.combine == "idf"
+        self._idf = None
+
     def _forward(self, inputs):
         simmat = self.simmat.encode_query_doc(self.vocab, inputs)
 
-        if self.needs_idf:
-            inputs.query_idf = torch.full_like(
-                inputs.queries_tokids, float("-inf"), dtype=torch.float
-            )
-            log_nd = math.log(self.index.documentcount + 1)
-            for i, tok in enumerate(inputs.queries_toks):
-                for j, t in enumerate(tok):
-                    inputs.query_idf[i, j] = log_nd - math.log(
-                        self.index.term_df(t) + 1
-                    )
+        if self.needs_idf and getattr(inputs, "query_idf", None) is None:
+            inputs.query_idf = self.query_idf(inputs)
 
         qterm_features = self.histogram_pool(simmat, inputs)
         BAT, QLEN, _ = qterm_features.shape
         qterm_scores = self.hidden_2(torch.relu(self.hidden_1(qterm_features))).reshape(
             BAT, QLEN
         )
-        return self.combine(qterm_scores, inputs.query_idf)
+        # Padded query terms do not contribute to the score
+        qterm_scores = qterm_scores.masked_fill(inputs.queries_tokids == -1, 0.0)
+        return self.combine(qterm_scores, getattr(inputs, "query_idf", None))
+
+    def query_idf(self, inputs):
+        """Returns the IDF of the query tokens (-inf for padding)
+
+        The IDF is computed once for each vocabulary entry (when first seen),
+        and stored in a tensor indexed by token ID
+        """
+        tokids = inputs.queries_tokids.cpu()
+        padding = tokids == -1
+        tokids = tokids.clamp(min=0)
+        if self._idf is None:
+            self._idf = torch.full((self.vocab.lexicon_size(),), float("nan"))
+
+        query_idf = self._idf[tokids]
+        missing = torch.isnan(query_idf) & ~padding
+        if missing.any():
+            log_nd = math.log(self.index.documentcount + 1)
+            idfs = {}
+
+            def idf(tok):
+                if tok not in idfs:
+                    idfs[tok] = log_nd - math.log(self.index.term_df(tok) + 1)
+                return idfs[tok]
+
+            # Each distinct token is looked up once (e.g. when re-ranking,
+            # all the rows hold the same query)
+            positions = missing.nonzero()
+            unique, inverse = torch.unique(tokids[missing], return_inverse=True)
+            for k, tokid in enumerate(unique.tolist()):
+                rows = positions[inverse == k]
+                toks = {inputs.queries_toks[i][j] for i, j in rows.tolist()}
+
+                # Only cache the IDF if the ID identifies the token
+                # (this is not the case e.g. for unknown or hashed tokens)
+                try:
+                    canonical = self.vocab.id2tok(tokid)
+                except IndexError:
+                    canonical = None
+
+                if toks == {canonical}:
+                    self._idf[tokid] = idf(canonical)
+                    query_idf[rows[:, 0], rows[:, 1]] = self._idf[tokid]
+                else:
+                    for i, j in rows.tolist():
+                        tok = inputs.queries_toks[i][j]
+                        query_idf[i, j] = idf(tok)
+                        if tok == canonical:
+                            self._idf[tokid] = query_idf[i, j]
+
+        query_idf.masked_fill_(padding, float("-inf"))
+        return query_idf.to(inputs.queries_tokids.device)
+
+    def export_names(self):
+        names = super().export_names()
+        return names + ["query_idf"] if self.needs_idf else names
+
+    def export_inputs(self, inputs):
+        tensors = super().export_inputs(inputs)
+        return tensors + [self.query_idf(inputs)] if self.needs_idf else tensors
 
     def histogram_pool(self, simmat, inputs):
         histogram = self.hist(
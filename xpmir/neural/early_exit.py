@@ -0,0 +1,336 @@
+import json
+from pathlib import Path
+from typing import Iterator, List, Tuple
+import numpy as np
+import torch
+from torch import nn
+from experimaestro import config, task, param, pathoption, tqdm, Param
+from xpmir.evaluation import evaluate_results
+from xpmir.letor.learner import Learner
+from xpmir.letor.samplers import Records, SamplerRecord
+from xpmir.neural.vanilla_transformer import VanillaTransformer
+from xpmir.rankers import Scorer, ScoredDocument, TwoStageRetriever
+from xpmir.utils import EasyLogger
+
+
+class EarlyExitRanker(nn.Module):
+    """Scores query-document pairs with a vanilla transformer, computing the
+    transformer layers one at a time: after each exit layer, the pairs whose
+    exit score is below the exit threshold are not processed further (their
+    score is the exit score)
+
+    Arguments:
+        scorer: The trained scorer
+        exits: The exit layers (1-based)
+        heads: The linear heads (one per exit) predicting the final score
+            from the [CLS] representation
+        thresholds: The exit thresholds (None to compute all the layers)
+    """
+
+    def __init__(
+        self,
+        scorer: VanillaTransformer,
+        exits: List[int],
+        heads: nn.ModuleList,
+        thresholds: List[float] = None,
+    ):
+        super().__init__()
+        self.scorer = scorer
+        self.exits = exits
+        self.heads = heads
+        self.thresholds = thresholds
+
+        # If not None, the [CLS] representations at each exit are stored
+        self.features = None
+
+        # Number of computed (pair, layer)
+        self.computed = 0
+
+    @property
+    def vocab(self):
+        return self.scorer.vocab
+
+    @property
+    def qlen(self):
+        return self.scorer.qlen
+
+    @property
+    def dlen(self):
+        return self.scorer.dlen
+
+    def forward(self, inputs: Records):
+        vocab = self.scorer.vocab
+        self.scorer.tokenize(inputs)
+        BATCH = inputs.docs_tokids.shape[0]
+
+        toks, mask, segments, rows, _ = vocab.windows(
+            inputs.queries_tokids, self.scorer.documents(inputs)
+        )
+        hidden = vocab.embed(toks, segments)
+        extended = vocab.extended_mask(mask, hidden.dtype)
+
+        scores = hidden.new_zeros(BATCH)
+        active = torch.ones(BATCH, dtype=torch.bool, device=hidden.device)
+        exits = {layer: j for j, layer in enumerate(self.exits)}
+
+        for ix in range(vocab.num_layers()):
+            hidden = vocab.forward_layer(ix, hidden, extended)
+            self.computed += int(active.sum())
+            if ix + 1 not in exits:
+                continue
+
+            j = exits[ix + 1]
+            cls = vocab.aggregate(hidden[:, 0], rows, BATCH)
+            if self.features is not None:
+                self.features[j].append(cls.float().cpu().numpy())
+            if self.thresholds is None:
+                continue
+
+            exit_scores = self.heads[j](cls).reshape(BATCH)
+            stop = active & (exit_scores < self.thresholds[j])
+            scores[stop] = exit_scores[stop]
+            active &= ~stop
+            if not active.any():
+                return scores
+
+            keep = active[rows]
+            hidden, extended, rows = hidden[keep], extended[keep], rows[keep]
+
+        cls = vocab.aggregate(hidden[:, 0], rows, BATCH)
+        scores[active] = self.scorer.classifier(cls).reshape(BATCH)[active]
+        return scores
+
+    def rsv(self, query: str, documents: List[ScoredDocument]) -> List[ScoredDocument]:
+        inputs = Records()
+        for doc in documents:
+            inputs.add(SamplerRecord(query, doc.docid, doc.content, doc.score, None))
+
+        with torch.no_grad():
+            scores = self(inputs).cpu().numpy()
+
+        return [
+            ScoredDocument(document.docid, float(score))
+            for document, score in zip(documents, scores)
+        ]
+
+
+@param(
+    "max_loss",
+    default=0.01,
+    help="Maximum loss of the validation metric (with respect to the full "
+    "model) when choosing the thresholds",
+)
+@pathoption("path", "early-exit.pth")
+@pathoption("report", "report.json")
+@task()
+class CalibrateEarlyExit(EasyLogger):
+    """Fits early exit heads and thresholds for the best model of a learner
+    (a vanilla transformer) on the learner validation set
+
+    The heads are linear (ridge) regressions of the final score from the
+    [CLS] representation at the exit layers. The threshold of an exit is the
+    (same) quantile of the exit scores of the top-k documents (according to
+    the full model): the highest quantile whose (simulated) validation loss
+    is below max_loss is kept.
+
+    Attributes:
+        learner: The learner whose best model is used
+        exits: The exit layers (1-based)
+        quantiles: The quantiles of the top-k documents exit scores which
+            are tried as thresholds
+        topk: Number of documents (per query) used to compute the thresholds
+        ridge: Ridge regularization of the exit heads
+    """
+
+    learner: Param[Learner]
+    exits: Param[List[int]]
+    quantiles: Param[List[float]] = [0.0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.5]
+    topk: Param[int] = 100
+    ridge: Param[float] = 1.0
+
+    def config(self):
+        return EarlyExitScorer(learner=self.learner, path=self.path, report=self.report)
+
+    def candidates(self, scorer) -> Iterator[Tuple[str, Records]]:
+        """Iterates over the validation queries and candidates"""
+        validation = self.learner.validation
+        if validation.fixture is not None:
+            for qix, qid in enumerate(tqdm(validation.fixture.qids)):
+                yield qid, validation.fixture.records(qix, scorer)
+            return
+
+        for query in tqdm(list(validation.dataset.topics.iter())):
+            records = Records()
+            for doc in validation.retriever.retriever.retrieve(query.title):
+                records.add(
+                    SamplerRecord(query.title, doc.docid, doc.content, doc.score, None)
+                )
+            yield query.qid, records
+
+    def fit(self, features: np.ndarray, targets: np.ndarray) -> nn.Linear:
+        """Ridge regression of the targets"""
+        X = np.concatenate([features, np.ones((len(features), 1))], axis=1)
+        A = X.T @ X + self.ridge * np.eye(X.shape[1])
+        w = np.linalg.solve(A, X.T @ targets)
+
+        head = nn.Linear(features.shape[1], 1)
+        with torch.no_grad():
+            head.weight.copy_(torch.as_tensor(w[:-1]).reshape(1, -1))
+            head.bias.fill_(float(w[-1]))
+        return head
+
+    def simulate(self, queries, exit_scores, thresholds, nlayers):
+        """Returns the rankings and the fraction of computed layers"""
+        results, computed, total = [], 0, 0
+        for (qid, docids, final), scores in zip(queries, exit_scores):
+            result = final.copy()
+            layers = np.full(len(final), nlayers)
+            active = np.ones(len(final), dtype=bool)
+            for layer, s, threshold in zip(self.exits, scores, thresholds):
+                stop = active & (s < threshold)
+                result[stop] = s[stop]
+                layers[stop] = layer
+                active &= ~stop
+
+            computed += layers.sum()
+            total += len(final) * nlayers
+            results.append((qid, self.ranking(docids, result)))
+        return results, computed / max(total, 1)
+
+    def ranking(self, docids, scores):
+        topk = self.learner.validation.retriever.topk
+        order = np.argsort(-scores, kind="stable")[:topk]
+        return [ScoredDocument(docids[ix], float(scores[ix])) for ix in order]
+
+    def execute(self):
+        validation = self.learner.validation
+        assert isinstance(
+            validation.retriever, TwoStageRetriever
+        ), "calibration requires a two-stage validation retriever"
+        validation.initialize()
+
+        scorer = self.learner.bestmodel
+        scorer.eval()
+        assert isinstance(scorer, VanillaTransformer), "Only for vanilla transformers"
+        assert not scorer.add_runscore, "Run scores are not supported"
+        assert scorer.aggregation == "mean", "Only mean aggregation is supported"
+        assert scorer.vocab.layer == 0, "The last layer should be used"
+        nlayers = scorer.vocab.num_layers()
+        assert all(0 < layer < nlayers for layer in self.exits)
+
+        # Computes the final scores and the [CLS] representations
+        ranker = EarlyExitRanker(scorer, self.exits, None)
+        ranker.features = [[] for _ in self.exits]
+        queries = []
+        with torch.no_grad():
+            for qid, records in self.candidates(ranker):
+                scores = ranker(records).cpu().numpy()
+                queries.append((qid, records.docids, scores))
+
+        # Fit the heads
+        targets = np.concatenate([final for _, _, final in queries])
+        heads = nn.ModuleList()
+        exit_scores = [[] for _ in queries]
+        for features in ranker.features:
+            head = self.fit(np.concatenate(features), targets)
+            heads.append(head)
+            for i, f in enumerate(features):
+                with torch.no_grad():
+                    exit_scores[i].append(head(torch.as_tensor(f)).reshape(-1).numpy())
+
+        # Choose the thresholds
+        def top(final):
+            return np.argsort(-final, kind="stable")[: self.topk]
+
+        results = [(qid, self.ranking(docids, final)) for qid, docids, final in queries]
+        reference, _ = evaluate_results(
+            None, results, validation.dataset, validation.metrics
+        )
+        reference = reference[validation.metric]
+
+        best = {"quantile": None, "thresholds": None, "value": reference, "cost": 1.0}
+        for quantile in sorted(self.quantiles):
+            thresholds = [
+                float(
+                    np.quantile(
+                        np.concatenate(
+                            [s[j][top(q[2])] for q, s in zip(queries, exit_scores)]
+                        ),
+                        quantile,
+                    )
+                )
+                for j in range(len(self.exits))
+            ]
+            results, cost = self.simulate(queries, exit_scores, thresholds, nlayers)
+            value, _ = evaluate_results(
+                None, results, validation.dataset, validation.metrics
+            )
+            value = value[validation.metric]
+            self.logger.info(
+                "Quantile %f: %s=%f, cost %.3f",
+                quantile,
+                validation.metric,
+                value,
+                cost,
+            )
+            if reference - value <= self.max_loss and cost <= best["cost"]:
+                best = {
+                    "quantile": quantile,
+                    "thresholds": thresholds,
+                    "value": value,
+                    "cost": cost,
+                }
+
+        torch.save(
+            {
+                "exits": self.exits,
+                "heads": heads.state_dict(),
+                "thresholds": best["thresholds"],
+            },
+            self.path,
+        )
+        with self.report.open("wt") as fp:
+            json.dump(
+                {"metric": validation.metric, "reference": reference, **best},
+                fp,
+                indent=2,
+            )
+
+
+@config()
+class EarlyExitScorer(Scorer):
+    """A vanilla transformer scorer using early exit (all the layers are
+    computed if no thresholds were found during the calibration)
+
+    Attributes:
+        learner: The learner (whose best model is used)
+        path: The exit heads and thresholds
+        report: The calibration report
+    """
+
+    learner: Param[Learner]
+    path: Param[Path]
+    report: Param[Path]
+
+    _model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            data = torch.load(self.path)
+            scorer = self.learner.bestmodel
+            scorer.eval()
+
+            heads = nn.ModuleList(
+                nn.Linear(scorer.vocab.dim(), 1) for _ in data["exits"]
+            )
+            heads.load_state_dict(data["heads"])
+            self._model = EarlyExitRanker(
+                scorer, data["exits"], heads, data["thresholds"]
+            )
+            self._model.eval()
+
+        return self._model
+
+    def rsv(self, query: str, documents: List[ScoredDocument]) -> List[ScoredDocument]:
+        return self.model.rsv(query, documents)
@@ -0,0 +1,180 @@
+from pathlib import Path
+from typing import List
+import numpy as np
+import torch
+from torch import nn
+from experimaestro import config, task, param, pathoption, Choices, Param
+from xpmir.letor.learner import Learner
+from xpmir.letor.samplers import Records, SamplerRecord
+from xpmir.neural import InteractionScorer
+from xpmir.rankers import Scorer, ScoredDocument
+
+
+def pad_batch(tensors: List[torch.Tensor], size: int) -> List[torch.Tensor]:
+    """Pads the tensors to a fixed batch size (repeating the last row)"""
+    padded = []
+    for tensor in tensors:
+        missing = size - tensor.shape[0]
+        if missing > 0:
+            tensor = torch.cat([tensor, tensor[-1:].expand(missing, *tensor.shape[1:])])
+        padded.append(tensor)
+    return padded
+
+
+def pad_tokids(tokids: torch.Tensor, length: int) -> torch.Tensor:
+    """Pads the token IDs to a fixed length"""
+    return nn.functional.pad(tokids, (0, length - tokids.shape[1]), value=-1)
+
+
+class ExportModule(nn.Module):
+    """Wraps the scorer so that it can be traced"""
+
+    def __init__(self, scorer: InteractionScorer):
+        super().__init__()
+        self.scorer = scorer
+
+    def forward(self, *tensors):
+        return self.scorer.export_forward(*tensors)
+
+
+@param("format", default="torchscript", checker=Choices(["torchscript", "onnx"]))
+@config()
+class ExportedScorer(Scorer):
+    """A scorer based on an exported (TorchScript or ONNX) model
+
+    The scorer configuration is only used to compute the model inputs (e.g.
+    tokenization), the trained model being loaded from the exported file:
+    the vocabulary representations (e.g. word embeddings) are not loaded. The
+    model has static shapes: batches are padded to batch_size, queries and
+    documents to the scorer qlen and dlen.
+
+    Attributes:
+        scorer: The (non trained) scorer
+        path: The exported model
+        format: The export format (torchscript or onnx)
+        batch_size: The batch size of the exported model
+    """
+
+    scorer: Param[InteractionScorer]
+    path: Param[Path]
+    batch_size: Param[int] = 64
+
+    _model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            # Only the tokenizer is needed (the model is exported)
+            self.scorer.initialize_inputs()
+            if self.format == "onnx":
+                try:
+                    import onnxruntime
+                except Exception:
+                    self.logger.error("Install onnxruntime to use ONNX models")
+                    raise
+                self._model = onnxruntime.InferenceSession(str(self.path))
+            else:
+                self._model = torch.jit.load(str(self.path))
+                self._model.eval()
+
+        return self._model
+
+    def inputs(self, query: str, documents: List[ScoredDocument]):
+        """Returns the model inputs (padded to the model static shape)"""
+        inputs = Records()
+        for doc in documents:
+            assert doc.content is not None
+            inputs.add(SamplerRecord(query, doc.docid, doc.content, doc.score, None))
+
+        self.scorer.tokenize(inputs)
+        inputs.queries_tokids = pad_tokids(inputs.queries_tokids, self.scorer.qlen)
+        inputs.docs_tokids = pad_tokids(inputs.docs_tokids, self.scorer.dlen)
+        return pad_batch(self.scorer.export_inputs(inputs), self.batch_size)
+
+    def rsv(self, query: str, documents: List[ScoredDocument]) -> List[ScoredDocument]:
+        model = self.model
+        documents = list(documents)
+
+        scores = []
+        for i in range(0, len(documents), self.batch_size):
+            batch = documents[i : i + self.batch_size]
+            tensors = self.inputs(query, batch)
+            if self.format == "onnx":
+                names = self.scorer.export_names()
+                outputs = model.run(
+                    None, {name: t.numpy() for name, t in zip(names, tensors)}
+                )
+                scores.extend(outputs[0][: len(batch)])
+            else:
+                with torch.no_grad():
+                    scores.extend(model(*tensors)[: len(batch)].numpy())
+
+        return [
+            ScoredDocument(document.docid, float(score))
+            for document, score in zip(documents, scores)
+        ]
+
+
+@param("format", default="torchscript", checker=Choices(["torchscript", "onnx"]))
+@pathoption("path", "model")
+@task()
+class ExportScorer:
+    """Exports the best model of a learner to TorchScript (tracing) or ONNX
+
+    Attributes:
+        learner: The learner whose best model is exported
+        format: The export format (torchscript or onnx)
+        batch_size: The (static) batch size of the exported model
+    """
+
+    learner: Param[Learner]
+    batch_size: Param[int] = 64
+
+    def config(self):
+        return ExportedScorer(
+            scorer=self.learner.scorer,
+            path=self.path,
+            format=self.format,
+            batch_size=self.batch_size,
+        )
+
+    def example(self, scorer: InteractionScorer) -> List[torch.Tensor]:
+        """Returns example inputs (random tokens)"""
+        random = np.random.RandomState(0)
+        size = min(scorer.vocab.lexicon_size(), 1000)
+
+        inputs = Records()
+        for i in range(self.batch_size):
+            inputs.add(SamplerRecord("", str(i), "", 0.0, None))
+
+        for key, length in (("queries", scorer.qlen), ("docs", scorer.dlen)):
+            tokids = random.randint(1, size, (self.batch_size, length))
+            setattr(inputs, f"{key}_tokids", torch.LongTensor(tokids))
+            setattr(inputs, f"{key}_len", [length] * self.batch_size)
+            setattr(
+                inputs,
+                f"{key}_toks",
+                [[scorer.vocab.id2tok(int(i)) for i in row] for row in tokids],
+            )
+
+        return scorer.export_inputs(inputs)
+
+    def execute(self):
+        scorer = self.learner.bestmodel
+        scorer.eval()
+        module = ExportModule(scorer)
+        tensors = tuple(self.example(scorer))
+
+        if self.format == "onnx":
+            torch.onnx.export(
+                module,
+                tensors,
+                str(self.path),
+                input_names=scorer.export_names(),
+                output_names=["scores"],
+                opset_version=11,
+            )
+        else:
+            with torch.no_grad():
+                traced = torch.jit.trace(module, tensors, check_trace=False)
+            traced.save(str(self.path))
@@ -0,0 +1,67 @@
+from experimaestro import param, option, config
+import torch
+from torch import nn
+from . import InteractionScorer
+import xpmir.neural.modules as modules
+
+
+@param(
+    "mus",
+    default="-0.9,-0.7,-0.5,-0.3,-0.1,0.1,0.3,0.5,0.7,0.9,1.0",
+    help="Kernel means",
+)
+@param(
+    "sigmas",
+    default="0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.1,0.001",
+    help="Kernel standard deviations",
+)
+@param("grad_kernels", default=False, help="Learn the kernel parameters")
+@option(
+    "chunk",
+    default=256,
+    help="Number of document tokens processed at once by the kernel pooling "
+    "(0 to process the whole document at once)",
+)
+@option(
+    "chunked_backward",
+    default=True,
+    help="Recompute the kernels chunk by chunk in the backward pass (otherwise, "
+    "the kernel values of all the chunks are kept for the backward pass)",
+)
+@config()
+class Knrm(InteractionScorer):
+    """
+    Implementation of the K-NRM model from:
+      > Chenyan Xiong, Zhuyun Dai, James P. Callan, Zhiyuan Liu, and Russell Power. 2017.
+      > End-to-End Neural Ad-hoc Ranking with Kernel Pooling. In SIGIR.
+
+    The kernel pooling streams over chunks of the document, so that the
+    batch x query x document x kernels tensor is never built.
+    """
+
+    def initialize(self, random):
+        super().initialize(random)
+        self.simmat = self.interaction_matrix()
+        self.kernels = modules.RbfKernelBank.from_strs(
+            self.mus, self.sigmas, dim=1, requires_grad=self.grad_kernels
+        )
+        channels = self.vocab.emb_views()
+        self.combine = nn.Linear(self.kernels.count() * channels, 1)
+
+    def _forward(self, inputs):
+        simmat = self.simmat.encode_query_doc(self.vocab, inputs)
+        BATCH, CHANNELS, QLEN, DLEN = simmat.shape
+
+        # Soft-TF of each (query term, kernel)
+        dmask = (inputs.docs_tokids != -1).reshape(BATCH, 1, 1, DLEN)
+        soft_tf = self.kernels.pooled_sum(
+            simmat, dmask, self.chunk, self.chunked_backward
+        )
+
+        # Sum the log soft-TF over the query terms
+        qmask = (inputs.queries_tokids != -1).reshape(BATCH, 1, QLEN, 1)
+        features = torch.where(
+            qmask, (soft_tf + 1e-6).log(), torch.zeros_like(soft_tf)
+        ).sum(dim=2)
+
+        return self.combine(features.reshape(BATCH, -1))
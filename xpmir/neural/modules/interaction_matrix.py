@@ -1,3 +1,4 @@
+from collections import OrderedDict
 import torch
 from torch import nn
 from xpmir.vocab import Vocab
@@ -13,24 +14,79 @@ def binmat(a, b, padding=None):
     return result.float()
 
 
-def cos_simmat(a, b, amask=None, bmask=None):
+def l2_normalize(x):
+    """Normalize the embeddings (last dimension)"""
+    return x / (x.norm(p=2, dim=-1, keepdim=True) + 1e-9)  # avoid 0div
+
+
+def cos_simmat(
+    a, b, amask=None, bmask=None, chunk=0, dtype=None, anormed=False, bnormed=False
+):
+    """Cosine similarity matrix
+
+    Arguments:
+        chunk: If positive, the matrix is computed by chunks of (at most)
+            chunk columns -- this only bounds the intermediate (embedding
+            type) products: the whole result is allocated
+        dtype: The type of the result (by default, the embedding type)
+        anormed, bnormed: Whether the embeddings are already normalized
+    """
     BAT, A, B = a.shape[0], a.shape[1], b.shape[1]
-    a_denom = a.norm(p=2, dim=2).reshape(BAT, A, 1) + 1e-9  # avoid 0div
-    b_denom = b.norm(p=2, dim=2).reshape(BAT, 1, B) + 1e-9  # avoid 0div
-    result = a.bmm(b.permute(0, 2, 1)) / (a_denom * b_denom)
+    a = a if anormed else l2_normalize(a)
+    b = b if bnormed else l2_normalize(b)
     if amask is not None:
-        result = result * amask.reshape(BAT, A, 1)
+        a = a * amask.reshape(BAT, A, 1)
     if bmask is not None:
-        result = result * bmask.reshape(BAT, 1, B)
+        b = b * bmask.reshape(BAT, B, 1)
+
+    if (chunk <= 0 or chunk >= B) and (dtype is None or dtype == a.dtype):
+        return a.bmm(b.permute(0, 2, 1))
+
+    chunk = chunk if chunk > 0 else B
+    result = torch.empty(BAT, A, B, dtype=dtype or a.dtype, device=a.device)
+    for start in range(0, B, chunk):
+        b_chunk = b[:, start : start + chunk]
+        result[:, :, start : start + chunk] = a.bmm(b_chunk.permute(0, 2, 1))
     return result
 
 
 class InteractionMatrix(nn.Module):
-    def __init__(self, padding=-1):
+    """Computes the query-document interaction (similarity) matrices
+
+    Arguments:
+        padding: The padding token ID
+        budget: If positive, the (approximate) memory budget in bytes for
+            the intermediate results (the matrix is computed by chunks) --
+            the similarity matrices themselves are not included
+        dtype: The type of the similarity matrices (e.g. torch.float16 or
+            torch.bfloat16 to reduce the memory usage)
+        cache: If positive, the maximum number of (normalized) document
+            representations kept in memory (for static vocabularies encoding
+            documents independently of the query)
+    """
+
+    def __init__(self, padding=-1, budget=0, dtype=None, cache=0):
         super().__init__()
         self.padding = padding
+        self.budget = budget
+        self.dtype = dtype
+        self.cachesize = cache
+        self.cache = OrderedDict()
 
-    def forward(self, a_embed, b_embed, a_tok, b_tok):
+    def __getstate__(self):
+        # Do not save the cached representations
+        state = self.__dict__.copy()
+        state["cache"] = OrderedDict()
+        return state
+
+    def chunk(self, a_emb):
+        """Returns the number of document tokens processed at once"""
+        if self.budget <= 0:
+            return 0
+        BAT, A = a_emb.shape[0], a_emb.shape[1]
+        return max(1, self.budget // (BAT * A * a_emb.element_size()))
+
+    def forward(self, a_embed, b_embed, a_tok, b_tok, b_normed=False):
         wrap_list = lambda x: x if isinstance(x, list) else [x]
 
         a_embed = wrap_list(a_embed)
@@ -51,11 +107,88 @@ class InteractionMatrix(nn.Module):
                 simmats.append(binmat(a_emb, b_emb, padding=self.padding))
             else:
                 # cosine similarity matrix
-                a_mask = (a_tok.reshape(BAT, A, 1) != self.padding).float()
-                b_mask = (b_tok.reshape(BAT, 1, B) != self.padding).float()
-                simmats.append(cos_simmat(a_emb, b_emb, a_mask, b_mask))
+                a_mask = (a_tok.reshape(BAT, A, 1) != self.padding).to(a_emb.dtype)
+                b_mask = (b_tok.reshape(BAT, 1, B) != self.padding).to(b_emb.dtype)
+                simmats.append(
+                    cos_simmat(
+                        a_emb,
+                        b_emb,
+                        a_mask,
+                        b_mask,
+                        chunk=self.chunk(a_emb),
+                        dtype=self.dtype,
+                        bnormed=b_normed,
+                    )
+                )
         return torch.stack(simmats, dim=1)
 
     def encode_query_doc(self, encoder: Vocab, inputs):
-        enc = encoder.enc_query_doc(inputs.queries_tokids, inputs.docs_tokids)
+        if (
+            self.cachesize > 0
+            and encoder.static()
+            and type(encoder).enc_query_doc is Vocab.enc_query_doc
+            and len(inputs.docids) == inputs.docs_tokids.shape[0]
+        ):
+            query = encoder.enc_queries(inputs.queries_tokids)
+            doc = self.cached_documents(encoder, inputs)
+            return self(
+                query, doc, inputs.queries_tokids, inputs.docs_tokids, b_normed=True
+            )
+
+        docids = inputs.docids
+        if len(docids) != inputs.docs_tokids.shape[0]:
+            docids = None
+        enc = encoder.enc_query_doc(inputs.queries_tokids, inputs.docs_tokids, docids)
         return self(enc["query"], enc["doc"], inputs.queries_tokids, inputs.docs_tokids)
+
+    def cached_documents(self, encoder: Vocab, inputs):
+        """Returns the normalized document representations, using the cache
+        for the documents that were already encoded (documents without ID are
+        always encoded, and not cached)"""
+        docids, tokids = inputs.docids, inputs.docs_tokids
+        missing = [
+            i
+            for i, docid in enumerate(docids)
+            if docid is None or docid not in self.cache
+        ]
+        uncached = {}
+        if missing:
+            with torch.no_grad():
+                views = encoder(tokids[missing])
+            views = views if isinstance(views, list) else [views]
+            for j, i in enumerate(missing):
+                length = (tokids[i] != self.padding).sum().item()
+                entry = [
+                    (
+                        l2_normalize(view[j, :length])
+                        if view.is_floating_point()
+                        else view[j, :length]
+                    )
+                    for view in views
+                ]
+                if docids[i] is None:
+                    uncached[i] = entry
+                else:
+                    self.cache[docids[i]] = entry
+
+        # Build the (padded) batch
+        entries = []
+        for i, docid in enumerate(docids):
+            if docid is None:
+                entries.append(uncached[i])
+            else:
+                self.cache.move_to_end(docid)
+                entries.append(self.cache[docid])
+        while len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+        BAT, B = tokids.shape
+        result = []
+        for view in range(len(entries[0])):
+            first = entries[0][view]
+            padding = 0 if first.is_floating_point() else self.padding
+            batch = first.new_full((BAT, B, *first.shape[1:]), padding)
+            for i, entry in enumerate(entries):
+                batch[i, : entry[view].shape[0]] = entry[view]
+            result.append(batch)
+        return result if len(result) > 1 else result[0]
@@ -2,6 +2,55 @@ import torch
 from torch import nn
 
 
+def rbf_pooled_sum(data, mask, mus, sigmas, chunk):
+    """Sums the (masked) kernel values over the last dimension of data,
+    processing chunk values at a time
+
+    Returns a tensor of shape data.shape[:-1] + (kernels,)
+    """
+    result = None
+    for start in range(0, data.shape[-1], chunk):
+        x = data[..., start : start + chunk].unsqueeze(-1)
+        adj = x - mus
+        k = torch.exp(-0.5 * adj * adj / sigmas / sigmas)
+        k = (k * mask[..., start : start + chunk].unsqueeze(-1)).sum(dim=-2)
+        result = k if result is None else result + k
+    return result
+
+
+class RbfPooledSum(torch.autograd.Function):
+    """Same as rbf_pooled_sum, but the backward pass is also chunked (kernel
+    values are recomputed instead of being kept for each chunk)"""
+
+    @staticmethod
+    def forward(ctx, data, mask, mus, sigmas, chunk):
+        ctx.save_for_backward(data, mask, mus, sigmas)
+        ctx.chunk = chunk
+        return rbf_pooled_sum(data, mask, mus, sigmas, chunk)
+
+    @staticmethod
+    def backward(ctx, grad):
+        data, mask, mus, sigmas = ctx.saved_tensors
+        chunk = ctx.chunk
+        grad_data = torch.empty_like(data) if ctx.needs_input_grad[0] else None
+        grad_mus = torch.zeros_like(mus)
+        grad_sigmas = torch.zeros_like(sigmas)
+
+        grad = grad.unsqueeze(-2)
+        for start in range(0, data.shape[-1], chunk):
+            x = data[..., start : start + chunk].unsqueeze(-1)
+            adj = x - mus
+            k = torch.exp(-0.5 * adj * adj / sigmas / sigmas)
+            g = grad * k * mask[..., start : start + chunk].unsqueeze(-1)
+            g = g * adj / sigmas / sigmas
+            if grad_data is not None:
+                grad_data[..., start : start + chunk] = -g.sum(dim=-1)
+            grad_mus += g.reshape(-1, mus.shape[0]).sum(dim=0)
+            grad_sigmas += (g * adj / sigmas).reshape(-1, sigmas.shape[0]).sum(dim=0)
+
+        return grad_data, None, grad_mus, grad_sigmas, None
+
+
 class RbfKernelBank(nn.Module):
     def __init__(self, mus=None, sigmas=None, dim=0, requires_grad=True):
         super().__init__()
@@ -19,6 +68,22 @@ class RbfKernelBank(nn.Module):
         adj = data - mus
         return torch.exp(-0.5 * adj * adj / sigmas / sigmas)
 
+    def pooled_sum(self, data, mask, chunk=0, chunked_backward=True):
+        """Sums the kernel values over the last dimension of data (weighted by
+        the mask), without building the full tensor of kernel values
+
+        Arguments:
+            data: The values (e.g. B x Q x D similarities)
+            mask: A mask (broadcastable to data)
+            chunk: The number of values processed at once (0 for all)
+            chunked_backward: Whether the backward pass is chunked
+        """
+        mask = mask.to(data.dtype).expand_as(data)
+        chunk = chunk if chunk > 0 else data.shape[-1]
+        if chunked_backward and torch.is_grad_enabled():
+            return RbfPooledSum.apply(data, mask, self.mus, self.sigmas, chunk)
+        return rbf_pooled_sum(data, mask, self.mus, self.sigmas, chunk)
+
     def count(self):
         return self.mus.shape[0]
 
@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+import torch
+from experimaestro import config, param, Choices, Param, Option
+from xpmir.utils import EasyLogger
+
+
+@param("scoring", default="bm25", checker=Choices(["bm25", "exact"]))
+@config()
+class PassageSelector(EasyLogger):
+    """Selects the passages of the documents which are the most similar to
+    the query (e.g. before a cross-encoder, to bound its cost per document)
+
+    Documents are split into fixed-size passages, scored with BM25 (the
+    statistics being computed over the passages of the batch) or by exact
+    match (number of query token occurrences). The selected passages are
+    concatenated in document order.
+
+    Attributes:
+        count: Number of passages kept per document
+        length: Number of tokens of a passage (0 to use the default length,
+            e.g. the size of the cross-encoder windows)
+        stride: Distance (in tokens) between the start of two passages (0 for
+            non overlapping passages)
+        scoring: Passage scoring (bm25 or exact)
+        k1: BM25 k1 parameter
+        b: BM25 b parameter
+        cache: Number of documents whose passages are kept in memory
+    """
+
+    count: Param[int] = 4
+    length: Param[int] = 0
+    stride: Param[int] = 0
+    k1: Param[float] = 0.9
+    b: Param[float] = 0.4
+    cache: Option[int] = 1000
+
+    _passages = None
+
+    def __getstate__(self):
+        return {
+            key: value for key, value in self.__dict__.items() if key != "_passages"
+        }
+
+    @staticmethod
+    def split(tokids: np.ndarray, length: int, stride: int) -> np.ndarray:
+        """Returns the passages (padded with -1) of a document"""
+        n = int((tokids != -1).sum())
+        starts = np.arange(0, max(n - length, 0) + 1, stride)
+        if starts[-1] + length < n:
+            starts = np.append(starts, starts[-1] + stride)
+        ix = starts[:, None] + np.arange(length)
+        return np.where(ix < n, tokids[np.minimum(ix, max(n - 1, 0))], -1)
+
+    def passages(
+        self, docid: Optional[str], tokids: np.ndarray, length: int, stride: int
+    ) -> np.ndarray:
+        """Returns the passages of a document (using the cache if possible)"""
+        if docid is None or self.cache <= 0:
+            return PassageSelector.split(tokids, length, stride)
+
+        if self._passages is None:
+            self._passages = OrderedDict()
+        key = (docid, length, stride)
+        if key not in self._passages:
+            self._passages[key] = PassageSelector.split(tokids, length, stride)
+            while len(self._passages) > self.cache:
+                self._passages.popitem(last=False)
+        self._passages.move_to_end(key)
+        return self._passages[key]
+
+    def score(self, passages: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Scores the passages (N x length) with respect to their query
+        (N x qlen)"""
+        qmask = queries != -1
+        tf = ((passages[:, :, None] == queries[:, None, :]) & qmask[:, None, :]).sum(1)
+        if self.scoring == "exact":
+            return tf.sum(1).astype(np.float32)
+
+        # Document frequencies (number of passages containing each query token)
+        N = len(passages)
+        terms = np.unique(queries[qmask])
+        if len(terms) == 0:
+            return np.zeros(N, dtype=np.float32)
+        ix = np.searchsorted(terms, passages).clip(max=len(terms) - 1)
+        found = (terms[ix] == passages) & (passages != -1)
+        keys = np.unique((np.arange(N)[:, None] * len(terms) + ix)[found])
+        df = np.bincount(keys % len(terms), minlength=len(terms))
+        df = df[np.searchsorted(terms, queries).clip(max=len(terms) - 1)]
+        idf = np.log(1 + (N - df + 0.5) / (df + 0.5))
+
+        plen = (passages != -1).sum(1)
+        norm = self.k1 * (1 - self.b + self.b * plen / max(plen.mean(), 1))
+        scores = idf * tf * (self.k1 + 1) / (tf + norm[:, None])
+        return (scores * qmask).sum(1)
+
+    def select(
+        self,
+        queries_tok: torch.Tensor,
+        docs_tok: torch.Tensor,
+        docids: List[str] = None,
+        length: int = 0,
+    ) -> torch.Tensor:
+        """Returns the (padded) token IDs of the selected passages"""
+        length = self.length or length
+        stride = self.stride or length
+        if docs_tok.shape[1] <= self.count * length and stride == length:
+            # All the passages are selected
+            return docs_tok
+
+        BATCH = docs_tok.shape[0]
+        docids = docids if docids and len(docids) == BATCH else [None] * BATCH
+        docs, queries = docs_tok.cpu().numpy(), queries_tok.cpu().numpy()
+        passages = [
+            self.passages(docid, tokids, length, stride)
+            for docid, tokids in zip(docids, docs)
+        ]
+        counts = np.array([len(p) for p in passages])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        passages = np.concatenate(passages)
+        scores = self.score(passages, queries[np.repeat(np.arange(BATCH), counts)])
+
+        result = np.full((BATCH, self.count * length), -1, dtype=np.int64)
+        for i in range(BATCH):
+            start, end = offsets[i], offsets[i + 1]
+            top = np.arange(end - start)
+            if len(top) > self.count:
+                top = np.argpartition(-scores[start:end], self.count - 1)
+                top = np.sort(top[: self.count])
+            selected = passages[start + top].reshape(-1)
+            result[i, : len(selected)] = selected
+
+        width = max(int((result != -1).any(0).nonzero()[0].max(initial=0)) + 1, 1)
+        return torch.as_tensor(result[:, :width], device=docs_tok.device)
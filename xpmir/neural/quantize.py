@@ -0,0 +1,167 @@
+import itertools
+import json
+import time
+from pathlib import Path
+from typing import List
+import numpy as np
+import torch
+from torch import nn
+from experimaestro import config, task, param, pathoption, Param
+from xpmir.letor import load_checkpoint
+from xpmir.letor.learner import Learner, ValidationState
+from xpmir.letor.samplers import Records
+from xpmir.rankers import Scorer, ScoredDocument
+from xpmir.utils import EasyLogger
+
+
+class StaticLinear(nn.Module):
+    """A linear layer whose inputs are quantized (static quantization)"""
+
+    def __init__(self, linear: nn.Linear):
+        super().__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.linear = linear
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def wrap_linear(module: nn.Module, qconfig):
+    """Wraps (recursively) the linear layers for static quantization"""
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            wrapper = StaticLinear(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            wrap_linear(child, qconfig)
+
+
+@param(
+    "calibration",
+    default=0,
+    help="Number of training batches (sampled as by the learner trainer) used "
+    "to calibrate a static quantization of the linear layers (if 0, use "
+    "dynamic quantization)",
+)
+@param(
+    "max_loss",
+    default=0.01,
+    help="Maximum loss of the validation metric (with respect to fp32) "
+    "for the quantized model to be used",
+)
+@pathoption("path", "model.pth")
+@pathoption("report", "report.json")
+@task()
+class QuantizeScorer(EasyLogger):
+    """Int8 post-training quantization of the best model of a learner (CPU)
+
+    The quantized and full precision models are compared on the learner
+    validation set, and the results are stored in the report.
+    """
+
+    learner: Param[Learner]
+
+    def config(self):
+        return QuantizedScorer(learner=self.learner, path=self.path, report=self.report)
+
+    def load(self):
+        state = ValidationState()
+        state.load(self.learner.bestpath, optimizer=False)
+        state.ranker.eval()
+        return state
+
+    def quantize(self, ranker):
+        if self.calibration <= 0:
+            return torch.quantization.quantize_dynamic(
+                ranker, {nn.Linear}, dtype=torch.qint8, inplace=True
+            )
+
+        # Calibrate on training data (validation queries are used to accept
+        # or reject the quantized model)
+        trainer = self.learner.trainer
+        trainer.sampler.initialize(np.random.RandomState(0))
+        records = trainer.sampler.record_iter()
+
+        engine = torch.backends.quantized.engine
+        wrap_linear(ranker, torch.quantization.get_default_qconfig(engine))
+        torch.quantization.prepare(ranker, inplace=True)
+        with torch.no_grad():
+            for _ in range(self.calibration):
+                batch = Records()
+                for record in itertools.islice(records, trainer.batch_size):
+                    batch.add(record)
+                ranker(batch)
+        return torch.quantization.convert(ranker, inplace=True)
+
+    def execute(self):
+        validation = self.learner.validation
+        validation.initialize()
+
+        fp32 = self.load()
+        int8 = self.load()
+        self.logger.info("Quantizing the model")
+        int8.ranker = self.quantize(int8.ranker)
+
+        timings = {}
+        for key, state in (("fp32", fp32), ("int8", int8)):
+            start = time.perf_counter()
+            validation.compute(state)
+            timings[key] = time.perf_counter() - start
+            self.logger.info(
+                "%s: %s=%f (%.1fs)", key, validation.metric, state.value, timings[key]
+            )
+
+        loss = fp32.value - int8.value
+        report = {
+            "metric": validation.metric,
+            "loss": loss,
+            "accepted": loss <= self.max_loss,
+            "fp32": {"metrics": fp32.metrics, "time": timings["fp32"]},
+            "int8": {"metrics": int8.metrics, "time": timings["int8"]},
+        }
+
+        torch.save(int8.ranker, self.path)
+        with self.report.open("wt") as fp:
+            json.dump(report, fp, indent=2)
+
+
+@config()
+class QuantizedScorer(Scorer):
+    """A scorer using the quantized model (or the full precision one if the
+    quantized model was rejected, i.e. the validation loss was too high)
+
+    Attributes:
+        learner: The learner (used if the quantized model was rejected)
+        path: The quantized model
+        report: The quantization report
+    """
+
+    learner: Param[Learner]
+    path: Param[Path]
+    report: Param[Path]
+
+    _model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self.report.open("rt") as fp:
+                report = json.load(fp)
+
+            if report["accepted"]:
+                self._model = load_checkpoint(self.path)
+                self._model.eval()
+            else:
+                self.logger.warning(
+                    "Quantized model rejected (%s loss %f): using fp32",
+                    report["metric"],
+                    report["loss"],
+                )
+                self._model = self.learner.bestmodel
+
+        return self._model
+
+    def rsv(self, query: str, documents: List[ScoredDocument]) -> List[ScoredDocument]:
+        return self.model.rsv(query, documents)
@@ -0,0 +1,70 @@
+from typing import Optional
+from experimaestro import config, param, Choices, Param
+from torch import nn
+from xpmir.letor.samplers import Records
+from xpmir.neural.passages import PassageSelector
+from . import InteractionScorer
+
+
+@param(
+    "aggregation",
+    default="mean",
+    checker=Choices(["mean", "max", "first"]),
+    help="How to aggregate the windows of long documents: average the [CLS] "
+    "representations (mean), maximum window score (max, MaxP), or only use "
+    "the first window (first, FirstP)",
+)
+@config()
+class VanillaTransformer(InteractionScorer):
+    """Vanilla transformer cross-encoder, i.e. a linear layer on top of the
+    [CLS] representation of [CLS] QUERY [SEP] DOCUMENT [SEP]
+
+    Implementation of the Vanilla BERT model from:
+      > Sean MacAvaney, Andrew Yates, Arman Cohan, Nazli Goharian. 2019.
+      > CEDR: Contextualized Embeddings for Document Ranking. In SIGIR.
+
+    The vocabulary should be a joint transformer (e.g.
+    `xpmir.vocab.huggingface.JointTransformer`) using one layer.
+
+    Attributes:
+        dropout: Dropout probability applied to the [CLS] representation
+        selector: If set, only the passages selected by this (cheap) stage
+            are given to the transformer (by default, passages have the
+            size of a window)
+    """
+
+    dropout: Param[float] = 0.1
+    selector: Param[Optional[PassageSelector]] = None
+
+    def __validate__(self):
+        # Documents are split into windows: only the query should fit
+        assert (
+            self.qlen + 3 < self.vocab.maxtokens()
+        ), f"The maximum query length ({self.qlen}) is too long for the vocab"
+
+    def initialize(self, random):
+        super().initialize(random)
+        self.drop = nn.Dropout(self.dropout)
+        self.classifier = nn.Linear(self.vocab.dim(), 1)
+
+    def documents(self, inputs: Records):
+        """Returns the document token IDs given to the transformer"""
+        queries_tok, docs_tok = inputs.queries_tokids, inputs.docs_tokids
+        window = self.vocab.window_size(queries_tok.shape[1], docs_tok.shape[1])
+        if self.selector is not None:
+            docs_tok = self.selector.select(
+                queries_tok, docs_tok, inputs.docids, length=window
+            )
+        if self.aggregation == "first":
+            docs_tok = docs_tok[:, :window]
+        return docs_tok
+
+    def _forward(self, inputs: Records):
+        queries_tok, docs_tok = inputs.queries_tokids, self.documents(inputs)
+        enc = self.vocab.enc_query_doc(queries_tok, docs_tok)
+        if self.aggregation != "max":
+            return self.classifier(self.drop(enc["cls"]))
+
+        scores = self.classifier(self.drop(enc["windows_cls"])).reshape(-1)
+        result = scores.new_full((docs_tok.shape[0],), float("-inf"))
+        return result.scatter_reduce(0, enc["rows"], scores, "amax")
@@ -0,0 +1,345 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+from typing import List, Tuple
+import numpy as np
+import torch
+from experimaestro import config, task, param, pathoption, tqdm, Choices, Param, Option
+from xpmir.dm.data import Index
+from xpmir.rankers import Retriever, ScoredDocument
+from xpmir.utils import EasyLogger
+from xpmir.vocab.huggingface import IndependentTransformerVocab
+
+
+def encode(
+    vocab: IndependentTransformerVocab,
+    texts: List[str],
+    pooling: str,
+    seg_id: int,
+    maxlen=0,
+) -> np.ndarray:
+    """Returns the (pooled) representations of the texts"""
+    _, tokids, _ = vocab.batch_tokenize(texts, maxlen=maxlen)
+    with torch.no_grad():
+        results, cls = vocab._forward(tokids, seg_id=seg_id)
+        if pooling == "cls":
+            return cls.float().numpy()
+        mask = (tokids != -1).unsqueeze(2).to(results.dtype)
+        pooled = (results * mask).sum(1) / mask.sum(1).clamp(min=1)
+        return pooled.float().numpy()
+
+
+def topk(scores: np.ndarray, ids: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the k best (unsorted) scores and ids of each row"""
+    if scores.shape[1] <= k:
+        return scores, ids
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, top, 1), np.take_along_axis(ids, top, 1)
+
+
+def kmeans(
+    data: np.ndarray,
+    k: int,
+    iterations: int,
+    random: np.random.RandomState,
+    block=65536,
+) -> np.ndarray:
+    """Returns the centroids of the k-means clustering of data (Lloyd's algorithm)"""
+    centroids = data[random.choice(len(data), k, replace=False)].astype(np.float32)
+    for iteration in range(iterations):
+        assignments = assign(data, centroids, block)
+        counts = np.bincount(assignments, minlength=k)
+        order = np.argsort(assignments, kind="stable")
+        starts = np.cumsum(counts) - counts
+
+        sums = np.zeros_like(centroids)
+        sums[counts > 0] = np.add.reduceat(
+            data[order].astype(np.float32), starts[counts > 0]
+        )
+
+        # Re-initialize empty clusters with random points
+        empty = counts == 0
+        sums[empty] = data[random.choice(len(data), empty.sum())]
+        counts[empty] = 1
+        centroids = sums / counts[:, None]
+    return centroids
+
+
+def proximity(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """Returns a score which is decreasing with the L2 distance to the
+    centroids, i.e. x.c - |c|^2 / 2"""
+    return data.astype(np.float32) @ centroids.T - (centroids**2).sum(1) / 2
+
+
+def assign(data: np.ndarray, centroids: np.ndarray, block=65536) -> np.ndarray:
+    """Returns the index of the closest (L2) centroid of each row"""
+    assignments = np.empty(len(data), dtype=np.int64)
+    for start in range(0, len(data), block):
+        rows = data[start : start + block]
+        assignments[start : start + block] = proximity(rows, centroids).argmax(1)
+    return assignments
+
+
+def resize(array: np.memmap, rows: int) -> np.memmap:
+    """Resizes (the first dimension of) a memory-mapped .npy array"""
+    array.flush()
+    path = Path(array.filename)
+    tmppath = path.with_suffix(".tmp.npy")
+    resized = np.lib.format.open_memmap(
+        tmppath, mode="w+", dtype=array.dtype, shape=(rows, *array.shape[1:])
+    )
+    count = min(rows, len(array))
+    for start in range(0, count, 65536):
+        end = min(start + 65536, count)
+        resized[start:end] = array[start:end]
+    resized.flush()
+    del array
+    tmppath.replace(path)
+    return np.lib.format.open_memmap(path, mode="r+")
+
+
+@param("pooling", default="cls", checker=Choices(["cls", "mean"]))
+@config()
+class DenseIndex(EasyLogger):
+    """Dense (float16) representations of all the documents of an index
+
+    With an IVF (inverted file) coarse quantizer, documents are ordered by
+    cluster so that each (inverted) list is a contiguous block of rows.
+
+    Attributes:
+        index: The index containing the documents
+        vocab: The transformer used to encode queries and documents
+        pooling: How to compute the representation ([CLS] or mean of the
+            token representations)
+        path: The directory containing the representations
+    """
+
+    index: Param[Index]
+    vocab: Param[IndependentTransformerVocab]
+    path: Param[Path]
+
+    _data = None
+
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != "_data"}
+
+    @property
+    def data(self):
+        if self._data is None:
+            ivf = (self.path / "centroids.npy").is_file()
+            self._data = (
+                (self.path / "docids.txt").read_text().split("\n"),
+                np.load(self.path / "embeddings.npy", mmap_mode="r"),
+                np.load(self.path / "centroids.npy") if ivf else None,
+                np.load(self.path / "lists.npy") if ivf else None,
+            )
+        return self._data
+
+    def encode(self, texts: List[str], seg_id=0, maxlen=0) -> np.ndarray:
+        return encode(self.vocab, texts, self.pooling, seg_id, maxlen)
+
+
+@param("pooling", default="cls", checker=Choices(["cls", "mean"]))
+@pathoption("path", "dense")
+@task()
+class BuildDenseIndex(EasyLogger):
+    """Encodes all the documents of an index into a dense index
+
+    Attributes:
+        index: The index containing the documents
+        vocab: The (non trainable) transformer
+        pooling: How to compute the representations
+        maxlen: Maximum number of tokens kept for each document
+        nlist: Number of IVF lists (0 for a flat index)
+        iterations: Number of k-means iterations
+        sample: Number of documents used to compute the k-means centroids
+        batch_size: Number of documents encoded at once
+    """
+
+    index: Param[Index]
+    vocab: Param[IndependentTransformerVocab]
+    maxlen: Param[int] = 512
+    nlist: Param[int] = 0
+    iterations: Param[int] = 10
+    sample: Param[int] = 100000
+    batch_size: Option[int] = 32
+
+    def config(self):
+        return DenseIndex(
+            index=self.index, vocab=self.vocab, pooling=self.pooling, path=self.path
+        )
+
+    def __validate__(self):
+        assert self.vocab.layer != -1, "Only one layer can be used"
+
+    def execute(self):
+        assert not self.vocab.trainable, "the transformer should not be trainable"
+        self.vocab.initialize()
+        self.path.mkdir(parents=True, exist_ok=True)
+        dim = self.vocab.dim()
+
+        docids = []
+        embeddings = np.lib.format.open_memmap(
+            self.path / "embeddings.npy",
+            mode="w+",
+            dtype=np.float16,
+            shape=(self.index.documentcount, dim),
+        )
+        count = len(embeddings)
+
+        def add(batch):
+            nonlocal embeddings
+            start = len(docids)
+            if start + len(batch) > len(embeddings):
+                embeddings = resize(embeddings, 2 * (start + len(batch)))
+            embeddings[start : start + len(batch)] = encode(
+                self.vocab, [text for _, text in batch], self.pooling, 1, self.maxlen
+            )
+            docids.extend(docid for docid, _ in batch)
+
+        batch = []
+        for docid in tqdm(self.index.docids(), total=self.index.documentcount):
+            batch.append((docid, self.index.document_text(docid)))
+            if len(batch) >= self.batch_size:
+                add(batch)
+                batch = []
+        if batch:
+            add(batch)
+
+        # The document count of the index might be an estimate
+        if len(docids) != count:
+            self.logger.warning(
+                "Read %d documents (index count: %d)", len(docids), count
+            )
+        if len(docids) != len(embeddings):
+            embeddings = resize(embeddings, len(docids))
+
+        if self.nlist > 0:
+            self.logger.info("Computing %d IVF centroids", self.nlist)
+            random = np.random.RandomState(0)
+            sample = np.sort(random.permutation(len(docids))[: self.sample])
+            centroids = kmeans(embeddings[sample], self.nlist, self.iterations, random)
+            assignments = assign(embeddings, centroids)
+
+            # Order the documents by list
+            order = np.argsort(assignments, kind="stable")
+            lists = np.zeros(self.nlist + 1, dtype=np.int64)
+            lists[1:] = np.cumsum(np.bincount(assignments, minlength=self.nlist))
+            ordered = np.lib.format.open_memmap(
+                self.path / "embeddings.tmp.npy",
+                mode="w+",
+                dtype=np.float16,
+                shape=embeddings.shape,
+            )
+            for start in range(0, len(order), 65536):
+                ordered[start : start + 65536] = embeddings[
+                    order[start : start + 65536]
+                ]
+            ordered.flush()
+            del embeddings, ordered
+            (self.path / "embeddings.tmp.npy").replace(self.path / "embeddings.npy")
+            docids = [docids[ix] for ix in order]
+
+            np.save(self.path / "centroids.npy", centroids)
+            np.save(self.path / "lists.npy", lists)
+        else:
+            embeddings.flush()
+
+        (self.path / "docids.txt").write_text("\n".join(docids))
+        self.logger.info("Encoded %d documents", len(docids))
+
+
+@param("dense", DenseIndex, help="The dense index")
+@param("nprobe", default=0, help="Number of IVF lists searched (0 for all)")
+@config()
+class DenseRetriever(Retriever):
+    """Retrieves documents by (exact or IVF) maximum inner product search
+    over a dense index, on CPU
+
+    The document matrix is processed by blocks (matrix products, followed by
+    a top-k selection with argpartition), the blocks (or, for IVF, the
+    queries) being dispatched over threads.
+
+    Attributes:
+        content: Whether to return the document text (e.g. for re-ranking)
+        block_size: Number of documents scored at once
+        threads: Number of threads (0 for the number of CPUs)
+    """
+
+    content: Option[bool] = True
+    block_size: Option[int] = 65536
+    threads: Option[int] = 0
+
+    @property
+    def index(self) -> Index:
+        """The index containing the documents"""
+        return self.dense.index
+
+    def initialize(self):
+        self.dense.vocab.initialize()
+        self.executor = ThreadPoolExecutor(self.threads or os.cpu_count())
+
+    def retrieve(self, query: str) -> List[ScoredDocument]:
+        return self.search([query])[0]
+
+    def search(self, queries: List[str]) -> List[List[ScoredDocument]]:
+        """Retrieves the documents of a batch of queries"""
+        docids, embeddings, centroids, lists = self.dense.data
+        encoded = self.dense.encode(queries, seg_id=0)
+
+        if centroids is None or self.nprobe <= 0 or self.nprobe >= len(centroids):
+            scores, ids = self.flat(encoded, embeddings)
+        else:
+            results = list(
+                self.executor.map(
+                    lambda q: self.ivf(q, embeddings, centroids, lists), encoded
+                )
+            )
+            scores = [s for s, _ in results]
+            ids = [i for _, i in results]
+
+        results = []
+        for q_scores, q_ids in zip(scores, ids):
+            order = np.argsort(-q_scores, kind="stable")
+            results.append(
+                [
+                    ScoredDocument(
+                        docids[ix],
+                        float(score),
+                        (
+                            self.index.document_text(docids[ix])
+                            if self.content
+                            else None
+                        ),
+                    )
+                    for score, ix in zip(q_scores[order], q_ids[order])
+                ]
+            )
+        return results
+
+    def block(self, queries: np.ndarray, embeddings: np.ndarray, start: int):
+        """Returns the top-k scores and ids of a block of documents"""
+        rows = embeddings[start : start + self.block_size].astype(np.float32)
+        scores = queries @ rows.T
+        ids = np.broadcast_to(np.arange(start, start + len(rows)), scores.shape)
+        return topk(scores, ids, self.topk)
+
+    def flat(self, queries: np.ndarray, embeddings: np.ndarray):
+        """Exact search (blocks are dispatched over threads)"""
+        starts = range(0, len(embeddings), self.block_size)
+        blocks = list(
+            self.executor.map(lambda s: self.block(queries, embeddings, s), starts)
+        )
+        scores = np.concatenate([s for s, _ in blocks], axis=1)
+        ids = np.concatenate([i for _, i in blocks], axis=1)
+        return topk(scores, ids, self.topk)
+
+    def ivf(self, query: np.ndarray, embeddings, centroids, lists):
+        """Searches the nprobe lists whose centroids are the closest to the
+        query"""
+        closeness = proximity(query[None], centroids)[0]
+        probes = np.argpartition(-closeness, self.nprobe - 1)[: self.nprobe]
+        ids = np.concatenate([np.arange(lists[p], lists[p + 1]) for p in probes])
+        scores = embeddings[ids].astype(np.float32) @ query
+        scores, ids = topk(scores[None], ids[None], self.topk)
+        return scores[0], ids[0]
@@ -0,0 +1,69 @@
+import pytest
+import torch
+from xpmir.neural.drmm import CountHistogram, LogCountHistogram, NormalizedHistogram
+
+
+def reference_histogram(simmat, dtoks, qtoks, nbins):
+    """Computes the histograms one (query token) row at a time"""
+    BATCH, CHANNELS, QLEN, DLEN = simmat.shape
+    bins = ((simmat.float() + 1.00001) / 2.0 * (nbins - 1)).long()
+    histogram = torch.zeros(BATCH, CHANNELS, QLEN, nbins)
+    for b in range(BATCH):
+        for c in range(CHANNELS):
+            for q in range(QLEN):
+                if qtoks[b, q] == -1:
+                    continue
+                weights = (dtoks[b] != -1).float()
+                histogram[b, c, q] = torch.bincount(bins[b, c, q], weights, nbins)
+    return histogram
+
+
+def random_inputs(seed, dtype=torch.float):
+    """Similarity matrices and (padded) token IDs"""
+    generator = torch.Generator().manual_seed(seed)
+    BATCH, CHANNELS, QLEN, DLEN = 4, 2, 5, 30
+    simmat = torch.rand(BATCH, CHANNELS, QLEN, DLEN, generator=generator) * 2 - 1
+    simmat[0, 0, 0, :3] = torch.tensor([-1.0, 1.0, 0.0])
+
+    qlens = torch.randint(1, QLEN + 1, (BATCH,), generator=generator)
+    dlens = torch.randint(0, DLEN + 1, (BATCH,), generator=generator)
+    dlens[0] = DLEN
+    qtoks = torch.where(torch.arange(QLEN) < qlens[:, None], 1, -1)
+    dtoks = torch.where(torch.arange(DLEN) < dlens[:, None], 1, -1)
+    return simmat.to(dtype), dlens, dtoks, qtoks
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("nbins", [5, 29])
+def test_count_histogram(seed, nbins):
+    simmat, dlens, dtoks, qtoks = random_inputs(seed)
+    result = CountHistogram(nbins=nbins).instance()(simmat, dlens, dtoks, qtoks)
+    expected = reference_histogram(simmat, dtoks, qtoks, nbins)
+    assert torch.equal(result, expected)
+
+
+@pytest.mark.parametrize("dtype", [torch.float16, torch.bfloat16])
+def test_count_histogram_half(dtype):
+    simmat, dlens, dtoks, qtoks = random_inputs(0, dtype)
+    result = CountHistogram(nbins=29).instance()(simmat, dlens, dtoks, qtoks)
+    assert result.dtype == torch.float
+    assert torch.equal(result, reference_histogram(simmat, dtoks, qtoks, 29))
+
+
+def test_normalized_histogram():
+    simmat, dlens, dtoks, qtoks = random_inputs(0)
+    dlens = dlens.clamp(min=1)
+    result = NormalizedHistogram(nbins=29).instance()(
+        simmat, dlens.tolist(), dtoks, qtoks
+    )
+    expected = reference_histogram(simmat, dtoks, qtoks, 29) / dlens.reshape(
+        -1, 1, 1, 1
+    )
+    assert torch.allclose(result, expected)
+
+
+def test_logcount_histogram():
+    simmat, dlens, dtoks, qtoks = random_inputs(1)
+    result = LogCountHistogram(nbins=29).instance()(simmat, dlens, dtoks, qtoks)
+    expected = (reference_histogram(simmat, dtoks, qtoks, 29) + 1e-5).log()
+    assert torch.allclose(result, expected)
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+import torch
+from xpmir.neural.modules.interaction_matrix import InteractionMatrix, l2_normalize
+
+
+def test_cached_documents():
+    embeddings = torch.nn.Embedding(10, 4)
+    encoded = []
+
+    def encoder(tokids):
+        encoded.append(tokids.shape[0])
+        return embeddings(tokids.clamp(min=0))
+
+    def expected(tokids):
+        mask = (tokids != -1).unsqueeze(-1)
+        return l2_normalize(embeddings(tokids.clamp(min=0))) * mask
+
+    matrix = InteractionMatrix(cache=2)
+    tokids = torch.tensor([[1, 2, -1], [3, 4, 5], [6, -1, -1], [1, 2, -1]])
+    inputs = SimpleNamespace(docids=["a", None, None, "a"], docs_tokids=tokids)
+    with torch.no_grad():
+        result = matrix.cached_documents(encoder, inputs)
+        assert torch.allclose(result, expected(tokids))
+        assert list(matrix.cache.keys()) == ["a"]
+
+        # Documents without ID are never taken from the cache
+        tokids = torch.tensor([[7, 8], [1, 2]])
+        inputs = SimpleNamespace(docids=[None, "a"], docs_tokids=tokids)
+        result = matrix.cached_documents(encoder, inputs)
+        assert torch.allclose(result, expected(tokids))
+    assert encoded == [4, 1]
@@ -0,0 +1,37 @@
+import torch
+from xpmir.neural.modules.rbf_kernels import RbfPooledSum, rbf_pooled_sum
+
+
+def random_inputs(seed):
+    generator = torch.Generator().manual_seed(seed)
+    data = torch.rand(2, 3, 7, generator=generator, dtype=torch.double) * 2 - 1
+    mask = (torch.rand(2, 3, 7, generator=generator) > 0.3).double()
+    mus = torch.linspace(-1, 1, 4, dtype=torch.double)
+    sigmas = torch.rand(4, generator=generator, dtype=torch.double) * 0.5 + 0.1
+    return data, mask, mus, sigmas
+
+
+def test_rbf_pooled_sum():
+    data, mask, mus, sigmas = random_inputs(0)
+    kernels = torch.exp(-0.5 * ((data.unsqueeze(-1) - mus) / sigmas) ** 2)
+    expected = (kernels * mask.unsqueeze(-1)).sum(-2)
+    for chunk in (1, 3, 7, 10):
+        result = rbf_pooled_sum(data, mask, mus, sigmas, chunk)
+        assert torch.allclose(result, expected)
+        assert torch.allclose(
+            RbfPooledSum.apply(data, mask, mus, sigmas, chunk), expected
+        )
+
+
+def test_rbf_pooled_sum_gradcheck():
+    data, mask, mus, sigmas = random_inputs(1)
+    data.requires_grad_()
+    mus.requires_grad_()
+    sigmas.requires_grad_()
+    for chunk in (2, 7):
+        assert torch.autograd.gradcheck(
+            lambda data, mus, sigmas: RbfPooledSum.apply(
+                data, mask, mus, sigmas, chunk
+            ),
+            (data, mus, sigmas),
+        )
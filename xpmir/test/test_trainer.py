@@ -0,0 +1,108 @@
+import pickle
+import pytest
+import numpy as np
+import torch
+from datamaestro_text.data.ir.csv import TrainingTriplets
+from xpmir.letor.distributed import DistributedContext
+from xpmir.letor.samplers import TripletBasedSampler
+from xpmir.letor.trainers import TrainContext, TrainState
+from xpmir.letor.trainers.pointwise import PointwiseTrainer
+
+
+def make_trainer(path):
+    triplets = TrainingTriplets(path=path / "triplets.tsv")
+    trainer = PointwiseTrainer(
+        sampler=TripletBasedSampler(triplets=triplets), batch_size=3
+    ).instance()
+    context = TrainContext(None, path / "checkpoints", DistributedContext())
+    trainer.initialize(np.random.RandomState(0), torch.nn.Linear(1, 1), context)
+    return trainer
+
+
+def test_state_dict(tmp_path):
+    (tmp_path / "triplets.tsv").write_text(
+        "".join(f"q{i}\tpositive {i}\tnegative {i}\n" for i in range(7))
+    )
+
+    trainer = make_trainer(tmp_path)
+    for _ in range(2):
+        next(trainer.train_iter)
+    state = pickle.loads(pickle.dumps(trainer.state_dict()))
+    expected = [next(trainer.train_iter).documents for _ in range(4)]
+    expected_rand = torch.rand(3)
+
+    # Resumes after the first 6 records (and wraps around the file)
+    resumed = make_trainer(tmp_path)
+    resumed.load_state_dict(state)
+    documents = [next(resumed.train_iter).documents for _ in range(4)]
+    assert documents == expected
+    assert documents[0] == ["positive 3", "negative 3", "positive 4"]
+    assert torch.equal(torch.rand(3), expected_rand)
+
+
+def test_checkpoint(tmp_path):
+    state = TrainState()
+    state.ranker = torch.nn.Linear(2, 1)
+    state.optimizer = torch.optim.Adam(state.ranker.parameters())
+    state.epoch = 3
+    state.save(tmp_path)
+
+    # Whole modules are loaded (even if torch only loads weights by default)
+    loaded = TrainState()
+    loaded.load(tmp_path, optimizer=False)
+    assert loaded.epoch == 3 and loaded.optimizer is None
+    assert torch.equal(loaded.ranker.weight, state.ranker.weight)
+
+    loaded.load(tmp_path)
+    assert isinstance(loaded.optimizer, torch.optim.Adam)
+
+
+class LengthRanker(torch.nn.Linear):
+    """Tokenizes documents as their word IDs (for the token budget)"""
+
+    vocab = None
+    dlen = 10
+
+    def __init__(self):
+        super().__init__(1, 1)
+
+    def tokenize_documents(self, docids, documents):
+        lens = [len(document.split()) for document in documents]
+        tokids = torch.zeros(len(documents), max(lens), dtype=torch.long)
+        return None, tokids, lens
+
+
+def make_budget_trainer(path, token_budget, **kwargs):
+    triplets = TrainingTriplets(path=path / "triplets.tsv")
+    trainer = PointwiseTrainer(
+        sampler=TripletBasedSampler(triplets=triplets),
+        token_budget=token_budget,
+        **kwargs,
+    ).instance()
+    context = TrainContext(None, path / "checkpoints", DistributedContext())
+    trainer.initialize(np.random.RandomState(0), LengthRanker(), context)
+    return trainer
+
+
+def test_budget_steps(tmp_path):
+    (tmp_path / "triplets.tsv").write_text(
+        "".join(f"q{i}\t{'word ' * i}\tnegative\n" for i in range(1, 6))
+    )
+
+    trainer = make_budget_trainer(
+        tmp_path, 4, batch_size=4, grad_acc_batch=2, bucket_buffer=10
+    )
+    for _ in range(3):
+        step = next(trainer.train_iter)
+        assert len(step) == 2
+        for batch in step:
+            assert (
+                len(batch.docids) * max(batch.docs_len) <= 4 or len(batch.docids) == 1
+            )
+
+    # The buffer holds a single batch: no step can be formed
+    trainer = make_budget_trainer(
+        tmp_path, 100, batch_size=4, grad_acc_batch=2, bucket_buffer=10
+    )
+    with pytest.raises(RuntimeError):
+        next(trainer.train_iter)
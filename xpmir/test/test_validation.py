@@ -0,0 +1,90 @@
+from types import SimpleNamespace
+import experimaestro.taskglobals as taskglobals
+from experimaestro import config, Param
+from xpmir.letor.learner import Validation
+from xpmir.rankers import ScoredDocument
+from xpmir.vocab import Vocab
+
+
+@config()
+class HashVocab(Vocab):
+    """Token IDs computed from the token characters"""
+
+    size: Param[int] = 100
+
+    def tok2id(self, tok):
+        return sum(tok.encode()) % self.size
+
+
+class Retriever:
+    def __init__(self):
+        self.queries = []
+
+    def retrieve(self, query):
+        self.queries.append(query)
+        return [
+            ScoredDocument(f"{query}-{i}", float(i), " ".join(["word"] * (i + 1)))
+            for i in range(4)
+        ]
+
+
+class SumScorer:
+    """Scores documents by the sum of their token IDs"""
+
+    qlen = 3
+
+    def __init__(self, vocab, dlen):
+        self.vocab = vocab
+        self.dlen = dlen
+
+    def __call__(self, records):
+        return records.docs_tokids.clamp(min=0).sum(1).float()
+
+
+def make_validation(vocab, identifier, dlen, retriever):
+    vocab.__xpmidentifier__ = identifier
+    topics = [
+        SimpleNamespace(qid="q1", title="hello world"),
+        SimpleNamespace(qid="q2", title="foo"),
+    ]
+    return SimpleNamespace(
+        __xpmtypename__="validation",
+        __xpmidentifier__="0",
+        retriever=SimpleNamespace(scorer=SumScorer(vocab, dlen), retriever=retriever),
+        dataset=SimpleNamespace(topics=SimpleNamespace(iter=lambda: topics)),
+    )
+
+
+def test_fixture(tmp_path, monkeypatch):
+    monkeypatch.setattr(taskglobals, "wspath", tmp_path, raising=False)
+    vocab = HashVocab().instance()
+    retriever = Retriever()
+
+    validation = make_validation(vocab, "v1", 2, retriever)
+    fixture = Validation.loadfixture(validation)
+    assert retriever.queries == ["hello world", "foo"]
+
+    records = fixture.records(0, validation.retriever.scorer)
+    assert records.docids == [f"hello world-{i}" for i in range(4)]
+    assert records.scores == [0.0, 1.0, 2.0, 3.0]
+    assert records.queries_tokids.tolist() == [vocab.tok2ids(["hello", "world"])] * 4
+    # Documents are truncated to dlen
+    word = vocab.tok2id("word")
+    assert records.docs_tokids.tolist() == [[word, -1]] + [[word, word]] * 3
+
+    # The candidates are re-ranked by the scorer
+    results = dict(fixture.rerank(validation.retriever.scorer, 2))
+    assert list(results) == ["q1", "q2"]
+    assert [document.score for document in results["q2"]] == [2 * word] * 2
+
+    # The fixture is reused for the same vocabulary and document length...
+    fixture = Validation.loadfixture(validation)
+    assert len(retriever.queries) == 2
+    assert fixture.docs_tokids.shape[0] == 7 * 2
+
+    # ... but built again otherwise
+    for identifier, dlen in (("v1", 3), ("v2", 2)):
+        validation = make_validation(vocab, identifier, dlen, retriever)
+        fixture = Validation.loadfixture(validation)
+    assert len(retriever.queries) == 6
+    assert fixture.docs_tokids.shape[0] == 7 * 2
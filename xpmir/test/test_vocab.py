@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import torch
+from xpmir.vocab import Vocab, unique_rows
+
+
+def reference_pad(rows, maxlen=0):
+    """Pads the sequences one at a time (with -1)"""
+    lens = [len(row) for row in rows]
+    width = max(lens) if maxlen <= 0 else min(maxlen, max(lens))
+    result = torch.full((len(rows), width), -1, dtype=torch.long)
+    for i, row in enumerate(rows):
+        row = row[:width]
+        result[i, : len(row)] = torch.tensor(row, dtype=torch.long)
+    return result, lens
+
+
+ROWS = [[3, 1, 4], [], [1, 5, 9, 2, 6], [0], [5, 3]]
+
+
+@pytest.mark.parametrize("maxlen", [0, 2, 4, 10])
+def test_pad_sequences(maxlen):
+    vocab = Vocab().instance()
+    expected, expected_lens = reference_pad(ROWS, maxlen)
+
+    tokids, lens = vocab.pad_sequences(ROWS, maxlen=maxlen)
+    assert tokids.dtype == torch.long
+    assert torch.equal(tokids, expected)
+    assert lens == expected_lens
+
+    # Numpy rows, sequence first
+    rows = [np.array(row, dtype=np.int32) for row in ROWS]
+    tokids, _ = vocab.pad_sequences(rows, batch_first=False, maxlen=maxlen)
+    assert torch.equal(tokids, expected.t())
+
+
+def test_pad():
+    tokids = np.array([3, 1, 4, 1, 5], dtype=np.int64)
+    result = Vocab.pad(tokids, [3, 0, 2])
+    assert result.tolist() == [[3, 1, 4], [-1, -1, -1], [1, 5, -1]]
+
+    # The token IDs of the sequences are already truncated
+    result = Vocab.pad(np.array([3, 1, 1]), [3, 0, 1], maxlen=2)
+    assert result.tolist() == [[3, 1], [-1, -1], [1, -1]]
+
+    assert Vocab.pad(np.zeros(0, dtype=np.int64), [0, 0]).shape == (2, 0)
+
+
+def test_unique_rows():
+    tokids = torch.tensor([[1, 2, -1], [3, 4, 5], [1, 2, -1], [1, 2, -1]])
+    calls = []
+
+    def fn(rows):
+        calls.append(len(rows))
+        values = rows.sum(1, keepdim=True).float()
+        return values, [values * 2, rows]
+
+    values, (doubled, rows) = unique_rows(fn, tokids)
+    assert calls == [2]
+    assert torch.equal(rows, tokids)
+    assert values.flatten().tolist() == [2.0, 12.0, 2.0, 2.0]
+    assert torch.equal(doubled, values * 2)
+
+
+def test_unique_rows_distinct():
+    tokids = torch.tensor([[1, 2], [3, 4]])
+    result = unique_rows(lambda rows: rows * 2, tokids)
+    assert torch.equal(result, tokids * 2)
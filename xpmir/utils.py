@@ -1,6 +1,10 @@
+from collections import defaultdict
+from contextlib import contextmanager
 from logging import Logger
+from typing import Dict, List
 import inspect
 import logging
+import time
 
 
 class Handler:
@@ -64,3 +68,70 @@ class EasyLogger:
             self.__class__.__LOGGER__ = logger
 
         return logger
+
+
+class PhaseTimer:
+    """Measures the time spent in (possibly nested) phases
+
+    The time of a phase excludes the time spent in its sub-phases. Example:
+    ```
+    timer = PhaseTimer()
+    with timer("forward"):
+        ...
+    timer.add(records=16)
+    ```
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.reset()
+
+    def reset(self):
+        """Starts a new measurement period"""
+        self.durations = defaultdict(list)  # type: Dict[str, List[float]]
+        self.counts = defaultdict(int)  # type: Dict[str, int]
+        self.start = time.perf_counter()
+        self._children = []
+
+    @contextmanager
+    def __call__(self, phase: str):
+        if not self.enabled:
+            yield
+            return
+
+        start = time.perf_counter()
+        self._children.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.durations[phase].append(elapsed - self._children.pop())
+            if self._children:
+                self._children[-1] += elapsed
+
+    def add(self, **counts: int):
+        """Increments counters (e.g. number of processed records)"""
+        if self.enabled:
+            for key, value in counts.items():
+                self.counts[key] += value
+
+    def report(self) -> Dict:
+        """Returns a summary of the current period"""
+        elapsed = time.perf_counter() - self.start
+        return {
+            "elapsed": elapsed,
+            "phases": {
+                phase: {
+                    "total": sum(durations),
+                    "count": len(durations),
+                    "mean": sum(durations) / len(durations),
+                }
+                for phase, durations in self.durations.items()
+            },
+            **self.counts,
+            **{f"{key}_per_sec": value / elapsed for key, value in self.counts.items()},
+        }
+
+
+# Timer that does not measure anything
+NOTIMER = PhaseTimer(enabled=False)
@@ -1,78 +1,198 @@
 import sys
-import re
-from typing import List, Tuple
+import string
+import pickle
+import multiprocessing
+from itertools import chain
+from typing import Callable, List, Tuple
+import numpy as np
 import torch
-from experimaestro import config, param
+from experimaestro import config, param, Option
 from xpmir.letor.samplers import Records
 from xpmir.utils import EasyLogger
 
 
+def unique_rows(fn, tokids: torch.Tensor):
+    """Calls fn on the distinct rows of tokids, and broadcasts the results
+    back to the original rows (with index_select)
+
+    fn should return a tensor, or a list/tuple of tensors (or lists of
+    tensors), whose first dimension is the batch
+    """
+    unique, inverse = torch.unique(tokids, dim=0, return_inverse=True)
+    if unique.shape[0] == tokids.shape[0]:
+        return fn(tokids)
+
+    def broadcast(x):
+        if isinstance(x, (list, tuple)):
+            return type(x)(broadcast(y) for y in x)
+        return x.index_select(0, inverse.to(x.device))
+
+    return broadcast(fn(unique))
+
+
+# Maps the (UTF-8) bytes which are not lowercase ASCII letters or digits to
+# spaces
+TOKENIZE_TABLE = bytes(
+    c if chr(c) in string.ascii_lowercase + string.digits else ord(" ")
+    for c in range(256)
+)
+
+
+def tokenize_text(text: str) -> List[str]:
+    """Default tokenization: lowercase ASCII letters and digits sequences"""
+    # Same as replacing [^a-z0-9] by spaces, but without a regular
+    # expression (non ASCII characters are encoded with bytes >= 128)
+    return text.lower().encode("utf-8").translate(TOKENIZE_TABLE).decode().split()
+
+
+# The tokenization function of a tokenization worker process
+_worker_tokenize = None
+
+
+def _init_worker(tokenize: bytes):
+    global _worker_tokenize
+    _worker_tokenize = pickle.loads(tokenize)
+
+
+def _tokenize_worker(text: str) -> List[str]:
+    return _worker_tokenize(text)
+
+
 @config()
 class Vocab(EasyLogger):
     """
     Represents a vocabulary and corresponding neural encoding technique
     (e.g., embedding). This class can also handle the case of a cross-encoding of the
     query-document couple (e.g. BERT with [SEP]).
+
+    Attributes:
+        processes: Number of processes used to tokenize large batches (0 to
+            tokenize in the current process) -- vocabularies with their own
+            batch tokenizer (e.g. fast transformer tokenizers) ignore it
+        pool_threshold: Minimum number of texts for which the process pool
+            is used
     """
 
+    processes: Option[int] = 0
+    pool_threshold: Option[int] = 1000
+
     name = None
     __has_clstoken__ = False
 
+    _pool = None
+
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != "_pool"}
+
     def __postinit__(self):
         pass
 
+    def __del__(self):
+        if self._pool:
+            self._pool.terminate()
+
     def initialize(self):
         pass
 
+    def close(self):
+        """Stops the tokenization processes (if any)"""
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+        self._pool = None
+
+    def initialize_tokenizer(self):
+        """Initializes only what is needed to tokenize texts and convert
+        tokens to IDs (e.g. not the embeddings)"""
+        self.initialize()
+
     def tokenize(self, text):
         """
         Meant to be overwritten in to provide vocab-specific tokenization when necessary
         e.g., BERT's WordPiece tokenization
         """
-        text = text.lower()
-        text = re.sub(r"[^a-z0-9]", " ", text)
-        return text.split()
-
-    def pad_sequences(self, tokensList: List[List[int]], batch_first=True, maxlen=0):
-        padding_value = 0
-        lens = [len(s) for s in tokensList]
-        maxlen = min(maxlen, max(lens)) if maxlen > 0 else max(lens)
-
-        if batch_first:
-            out_tensor = torch.full(
-                (len(tokensList), maxlen), padding_value, dtype=torch.long
+        return tokenize_text(text)
+
+    def tokenize_function(self) -> Callable[[str], List[str]]:
+        """Returns the (picklable) tokenization function run by the
+        tokenization processes -- should be overridden with `tokenize` so
+        that the processes do not receive the whole vocabulary"""
+        if type(self).tokenize is Vocab.tokenize:
+            return tokenize_text
+        return self.tokenize
+
+    def tokenize_texts(self, texts: List[str]) -> List[List[str]]:
+        """Tokenizes texts (using the process pool for large batches)"""
+        if self.processes <= 0 or len(texts) < self.pool_threshold:
+            return [self.tokenize(text) for text in texts]
+
+        if self._pool is None and multiprocessing.current_process().daemon:
+            # e.g. asynchronous validation or data-parallel training processes
+            self.logger.warning(
+                "Daemonic processes cannot start tokenization processes: "
+                "tokenizing in the current process"
             )
-            for i, tokens in enumerate(tokensList):
-                out_tensor[i, : lens[i], ...] = torch.LongTensor(tokens[:maxlen])
-        else:
-            out_tensor = torch.full(
-                (maxlen, len(tokensList)), padding_value, dtype=torch.long
+            self._pool = False
+        if self._pool is False:
+            return [self.tokenize(text) for text in texts]
+
+        if self._pool is None:
+            # The workers only receive the (pickled) tokenization function
+            # (the pool does not reference the vocabulary)
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(
+                self.processes, _init_worker, (pickle.dumps(self.tokenize_function()),)
             )
-            for i, tokens in enumerate(tokensList):
-                out_tensor[: lens[i], i, ...] = tokens[:maxlen]
+        chunksize = max(1, len(texts) // (4 * self.processes))
+        return self._pool.map(_tokenize_worker, texts, chunksize)
+
+    @staticmethod
+    def pad(tokids: np.ndarray, lens: List[int], batch_first=True, maxlen=0):
+        """Pads the concatenated token IDs of the sequences (each one being
+        truncated to maxlen) in a single tensor"""
+        kept = np.minimum(lens, maxlen) if maxlen > 0 else np.asarray(lens)
+        out = np.full((len(lens), int(kept.max(initial=0))), -1, dtype=np.int64)
+        out[np.arange(out.shape[1]) < kept[:, None]] = tokids
+        out = torch.from_numpy(out)
+        return out if batch_first else out.t().contiguous()
 
-        return out_tensor, lens
+    def pad_sequences(self, tokensList: List[List[int]], batch_first=True, maxlen=0):
+        lens = [len(s) for s in tokensList]
+        if maxlen > 0:
+            tokensList = [tokens[:maxlen] for tokens in tokensList]
+        tokids = np.concatenate(
+            [np.asarray(tokens, dtype=np.int64) for tokens in tokensList]
+        )
+        return self.pad(tokids, lens, batch_first, maxlen), lens
 
     def batch_tokenize(
         self, texts: List[str], batch_first=True, maxlen=0
     ) -> Tuple[List[List[str]], torch.Tensor, List[int]]:
-        toks = [self.tokenize(text) for text in texts]
-        tokids, lens = self.pad_sequences(
-            [[self.tok2id(t) for t in tok] for tok in toks],
-            batch_first=batch_first,
-            maxlen=maxlen,
-        )
-        return toks, tokids, lens
+        toks = self.tokenize_texts(texts)
+        lens = [len(tok) for tok in toks]
 
-    def enc_query_doc(self, queries_tok, documents_tok):
+        # Only the kept tokens are converted (at once)
+        kept = [tok[:maxlen] for tok in toks] if maxlen > 0 else toks
+        tokids = np.array(self.tok2ids(list(chain.from_iterable(kept))), dtype=np.int64)
+        return toks, self.pad(tokids, lens, batch_first, maxlen), lens
+
+    def enc_query_doc(self, queries_tok, documents_tok, docids=None):
         """
         Returns encoded versions of the query and document from general **inputs dict
         Requires query_tok, doc_tok, query_len, and doc_len.
 
         May be overwritten in subclass to provide contextualized representation, e.g.
         joinly modeling query and document representations in BERT.
+
+        docids: the document IDs (if known), which allows to use pre-computed
+        document representations
         """
-        return {"query": self(queries_tok), "doc": self(documents_tok)}
+        return {"query": self.enc_queries(queries_tok), "doc": self(documents_tok)}
+
+    def enc_queries(self, queries_tok):
+        """Returns the query embeddings, encoding only once the queries that
+        appear several times in the batch (e.g. when re-ranking)"""
+        return unique_rows(self, queries_tok)
 
     def tok2id(self, tok: str) -> int:
         """
@@ -80,6 +200,13 @@ class Vocab(EasyLogger):
         """
         raise NotImplementedError()
 
+    def tok2ids(self, toks: List[str]) -> List[int]:
+        """
+        Converts tokens to integer ids (to be overridden when the ids can be
+        looked up in bulk)
+        """
+        return [self.tok2id(tok) for tok in toks]
+
     def id2tok(self, idx: int) -> str:
         """
         Converts an integer id to a token
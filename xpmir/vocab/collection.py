@@ -0,0 +1,255 @@
+import json
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+import torch
+from experimaestro import config, task, pathoption, tqdm, Param, Option
+from xpmir.dm.data import Index
+from xpmir.utils import EasyLogger
+from xpmir.vocab import Vocab
+
+
+class RaggedStore:
+    """Memory-mapped ragged arrays, i.e. arrays whose rows (e.g. the token
+    IDs of the documents) have a variable length
+
+    The directory contains the row keys (docids.txt), the row offsets
+    (offsets.npy) and, for each array, the concatenated rows (<name>.bin).
+    The arrays of a store share their row offsets.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.docids = (path / "docids.txt").read_text().split("\n")
+        self.offsets = np.load(path / "offsets.npy")
+        self._index = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def index(self) -> Dict[str, int]:
+        """Maps the row keys to the row indices"""
+        if self._index is None:
+            self._index = {docid: ix for ix, docid in enumerate(self.docids)}
+        return self._index
+
+    def array(self, name: str, dtype, dim: int = 0) -> np.ndarray:
+        """Returns the concatenated rows of an array (of dimension dim if
+        strictly positive)"""
+        path = self.path / f"{name}.bin"
+        if path.stat().st_size == 0:
+            values = np.empty(0, dtype=dtype)
+        else:
+            values = np.memmap(path, dtype=dtype, mode="r")
+        return values.reshape(-1, dim) if dim > 0 else values
+
+    def rows(self, ix: int) -> slice:
+        """Returns the slice of the ix-th row within the arrays"""
+        return slice(self.offsets[ix], self.offsets[ix + 1])
+
+    @staticmethod
+    def writer(path: Path, **dtypes) -> "RaggedStoreWriter":
+        """Returns a writer for the arrays (name=dtype) of a new store"""
+        return RaggedStoreWriter(path, dtypes)
+
+
+class RaggedStoreWriter:
+    """Writes a ragged store row by row (see `RaggedStore`)"""
+
+    def __init__(self, path: Path, dtypes: Dict[str, np.dtype]):
+        self.path = path
+        self.dtypes = dtypes
+        self.files = {name: (path / f"{name}.bin").open("wb") for name in dtypes}
+        self.docids = []
+        self.offsets = [0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, docid: str, **rows: np.ndarray):
+        """Adds a row (with the same length in all the arrays)"""
+        length = None
+        for name, row in rows.items():
+            assert length is None or len(row) == length, "Rows of different lengths"
+            length = len(row)
+            self.files[name].write(np.asarray(row, dtype=self.dtypes[name]).tobytes())
+        self.docids.append(docid)
+        self.offsets.append(self.offsets[-1] + length)
+
+    def close(self):
+        for fp in self.files.values():
+            fp.close()
+        (self.path / "docids.txt").write_text("\n".join(self.docids))
+        np.save(self.path / "offsets.npy", np.array(self.offsets, dtype=np.int64))
+
+
+@config()
+class TokenizedCollection(EasyLogger):
+    """The token IDs of all the documents of a collection
+
+    Token IDs are stored as a ragged memory-mapped array, so that documents
+    can be fetched by docid without retrieving and tokenizing their text.
+
+    Attributes:
+        vocab: The (static) vocabulary used to tokenize the documents
+        path: The directory containing the token IDs
+    """
+
+    vocab: Param[Vocab]
+    path: Param[Path]
+
+    DTYPE = np.int32
+
+    _data = None
+
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != "_data"}
+
+    @property
+    def data(self):
+        if self._data is None:
+            store = RaggedStore(self.path)
+            self._data = (
+                store,
+                np.load(self.path / "lengths.npy"),
+                store.array("tokids", TokenizedCollection.DTYPE),
+            )
+        return self._data
+
+    def document_tokids(self, docid: str) -> Tuple[np.ndarray, int]:
+        """Returns the (possibly truncated) token IDs and the length of a
+        document"""
+        store, lengths, tokids = self.data
+        ix = store.index[docid]
+        return tokids[store.rows(ix)], int(lengths[ix])
+
+    def batch(self, docids: List[str], maxlen=0) -> Tuple[torch.Tensor, List[int]]:
+        """Returns the padded token IDs and the lengths of documents"""
+        documents = [self.document_tokids(docid) for docid in docids]
+        tokids, _ = self.vocab.pad_sequences(
+            [doc_tokids for doc_tokids, _ in documents], maxlen=maxlen
+        )
+        return tokids, [length for _, length in documents]
+
+
+@pathoption("path", "tokenized")
+@task()
+class TokenizeCollection(EasyLogger):
+    """Tokenizes all the documents of an index with a static vocabulary
+
+    Attributes:
+        index: The index containing the documents
+        vocab: The (static) vocabulary
+        maxlen: Maximum number of tokens kept for each document (0 for all)
+        batch_size: Number of documents tokenized at once (large batches
+            can be tokenized by the vocabulary process pool)
+    """
+
+    index: Param[Index]
+    vocab: Param[Vocab]
+    maxlen: Param[int] = 0
+    batch_size: Option[int] = 1000
+
+    def config(self):
+        return TokenizedCollection(vocab=self.vocab, path=self.path)
+
+    def execute(self):
+        assert self.vocab.static(), "the vocabulary should be static"
+        self.vocab.initialize()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        lengths = []
+        with RaggedStore.writer(self.path, tokids=TokenizedCollection.DTYPE) as writer:
+
+            def tokenize(batch):
+                toks = self.vocab.tokenize_texts([text for _, text in batch])
+                for (docid, _), doc_toks in zip(batch, toks):
+                    kept = doc_toks[: self.maxlen] if self.maxlen > 0 else doc_toks
+                    writer.add(docid, tokids=self.vocab.tok2ids(kept))
+                    lengths.append(len(doc_toks))
+
+            batch = []
+            for docid in tqdm(self.index.docids(), total=self.index.documentcount):
+                batch.append((docid, self.index.document_text(docid)))
+                if len(batch) >= self.batch_size:
+                    tokenize(batch)
+                    batch = []
+            if batch:
+                tokenize(batch)
+        self.vocab.close()
+
+        np.save(self.path / "lengths.npy", np.array(lengths, dtype=np.int64))
+        self.logger.info("Tokenized %d documents", len(lengths))
+
+
+@config()
+class EncodedCollection(EasyLogger):
+    """Pre-computed token representations of all the documents of a
+    collection (see `xpmir.vocab.huggingface.EncodeCollection`)
+
+    Representations are stored as a ragged memory-mapped array, either in
+    float16 or in int8 (with one scaling factor per token).
+
+    Attributes:
+        path: The directory containing the representations
+    """
+
+    path: Param[Path]
+
+    DTYPES = {"float16": np.float16, "int8": np.int8}
+
+    _data = None
+
+    def __getstate__(self):
+        return {key: value for key, value in self.__dict__.items() if key != "_data"}
+
+    @property
+    def meta(self):
+        with (self.path / "meta.json").open("rt") as fp:
+            return json.load(fp)
+
+    @property
+    def data(self):
+        if self._data is None:
+            meta = self.meta
+            store = RaggedStore(self.path)
+            dtype = EncodedCollection.DTYPES[meta["dtype"]]
+            scales = None
+            if meta["dtype"] == "int8":
+                scales = store.array("scales", np.float32)
+            self._data = (
+                store,
+                store.array("embeddings", dtype, meta["dim"]),
+                scales,
+                np.load(self.path / "cls.npy", mmap_mode="r"),
+            )
+        return self._data
+
+    def document(self, docid: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the token and [CLS] representations of a document"""
+        store, embeddings, scales, cls = self.data
+        ix = store.index[docid]
+        rows = store.rows(ix)
+        result = embeddings[rows].astype(np.float32)
+        if scales is not None:
+            result *= scales[rows, None]
+        return result, cls[ix].astype(np.float32)
+
+    def batch(
+        self, docids: List[str], length: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Returns the token representations (zero-padded or truncated to
+        length) and the [CLS] representations of documents"""
+        documents = [self.document(docid) for docid in docids]
+        dim = documents[0][1].shape[0]
+
+        result = torch.zeros(len(docids), length, dim)
+        for i, (embeddings, _) in enumerate(documents):
+            embeddings = embeddings[:length]
+            result[i, : len(embeddings)] = torch.from_numpy(embeddings)
+        cls = torch.from_numpy(np.stack([cls for _, cls in documents]))
+        return result, cls
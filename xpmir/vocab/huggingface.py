@@ -1,5 +1,12 @@
+import json
+import logging
+from itertools import chain
+from typing import List, Optional
+import numpy as np
 import torch
-from experimaestro import param, config, Choices, Param
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+from experimaestro import config, task, pathoption, tqdm, Param, Option
 
 try:
     from transformers import AutoModel, AutoTokenizer
@@ -7,46 +14,226 @@ except Exception:
     logging.error("Install huggingface transformers to use these configurations")
     raise
 
+from xpmir.dm.data import Index
 from xpmir.neural.modules import CustomBertModelWrapper
+from xpmir.vocab.collection import EncodedCollection, RaggedStore
 import xpmir.vocab as vocab
 
 
 @config()
-class TransformerVocab(vocab.Vocab):
+class TransformerVocab(vocab.Vocab, nn.Module):
     """
     Args:
 
     model_id: Model ID from huggingface
     trainable: Whether BERT parameters should be trained
     layer: Layer to use (0 is the last, -1 to use them all)
+    window_batch: Maximum number of windows encoded at once (0 for no limit)
+    gradient_checkpointing: When training, recompute the layer activations
+        during the backward pass instead of storing them (trades compute for
+        memory, allowing larger batches)
+
+    With a fast tokenizer, batches are tokenized by its (multi-threaded)
+    batch encoder, so the processes and pool_threshold options are not used.
     """
 
     model_id: Param[str] = "bert-base-uncased"
     trainable: Param[bool] = False
     layer: Param[int] = 0
+    window_batch: Option[int] = 0
+    gradient_checkpointing: Option[bool] = False
 
     CLS: int
     SEP: int
 
-    def initialize(self):
-        super().initialize()
-        self.model = AutoModel.from_pretrained(self.model_id)
+    def initialize_tokenizer(self):
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_id)
-
-        layer = self.layer
-        if layer == -1:
-            layer = None
         self.CLS = self.tok2id("[CLS]")
         self.SEP = self.tok2id("[SEP]")
+
+    def initialize(self):
+        super().initialize()
+        self.model = AutoModel.from_pretrained(self.model_id)
+        self.initialize_tokenizer()
         if self.trainable:
             self.model.train()
+            if self.gradient_checkpointing:
+                self.model.gradient_checkpointing_enable()
+        else:
+            self.model.eval()
+            for parameter in self.model.parameters():
+                parameter.requires_grad = False
+
+    def layers(self, hidden_states):
+        """Selects the layer(s) from the hidden states (embeddings, then the
+        output of each layer)"""
+        if self.layer == -1:
+            return list(hidden_states)
+        if self.layer == 0:
+            return [hidden_states[-1]]
+        return [hidden_states[self.layer]]
+
+    @staticmethod
+    def split(toks, window: int):
+        """Splits the sequences into windows, keeping only the non empty
+        windows (and the first window of each sequence)
+
+        Returns the windows, their lengths, and for each window the index of
+        its sequence and its position in the sequence
+        """
+        BATCH, LEN = toks.shape
+        nwindows = max(1, (LEN + window - 1) // window)
+        toks = nn.functional.pad(toks, (0, nwindows * window - LEN), value=-1)
+        toks = toks.reshape(BATCH * nwindows, window)
+        lens = (toks != -1).sum(1)
+
+        keep = lens > 0
+        keep[::nwindows] = True
+        kept = keep.nonzero()[:, 0]
+        return toks[kept], lens[kept], kept // nwindows, kept % nwindows
+
+    @staticmethod
+    def unsplit(windows, rows, positions, size: int, length: int):
+        """Scatters the token representations of the windows back to the
+        sequences (the skipped windows are zeros)"""
+        WINDOW = windows.shape[1]
+        nwindows = max(1, (length + WINDOW - 1) // WINDOW)
+        result = windows.new_zeros(size, nwindows, WINDOW, windows.shape[2])
+        result[rows, positions] = windows
+        return result.reshape(size, nwindows * WINDOW, -1)[:, :length]
+
+    @staticmethod
+    def aggregate(cls, rows, size: int):
+        """Averages the [CLS] representations of the windows of each sequence"""
+        result = cls.new_zeros(size, cls.shape[1]).index_add_(0, rows, cls)
+        counts = torch.bincount(rows, minlength=size).clamp(min=1)
+        return result / counts.unsqueeze(1).to(cls.dtype)
+
+    def encode_windows(self, toks, mask, segments):
+        """Runs the transformer over the windows (rows)
+
+        Windows are processed by batches of (at most) window_batch rows of
+        similar lengths, each batch being trimmed to its longest row.
+        Returns the selected layer(s), padded to the full width.
+        """
+        columns = torch.arange(toks.shape[1], device=toks.device)
+        lengths = (mask * columns).amax(1) + 1
+
+        def encode(ix, width):
+            outputs = self.model(
+                input_ids=toks[ix, :width],
+                attention_mask=mask[ix, :width],
+                token_type_ids=segments[ix, :width],
+                output_hidden_states=True,
+            )
+            return self.layers(outputs.hidden_states)
+
+        if self.window_batch <= 0 or self.window_batch >= len(toks):
+            width = int(lengths.max())
+            layers = encode(slice(None), width)
+            padding = (0, 0, 0, toks.shape[1] - width)
+            return [nn.functional.pad(layer, padding) for layer in layers]
+
+        order = torch.argsort(lengths, descending=True)
+        results = None
+        for start in range(0, len(order), self.window_batch):
+            ix = order[start : start + self.window_batch]
+            width = int(lengths[ix[0]])
+            layers = encode(ix, width)
+            if results is None:
+                results = [
+                    layer.new_zeros(*toks.shape, layer.shape[2]) for layer in layers
+                ]
+            for result, layer in zip(results, layers):
+                result[ix, :width] = layer
+        return results
+
+    def num_layers(self) -> int:
+        return self.model.config.num_hidden_layers
+
+    def embed(self, ids, segments):
+        """Returns the input embeddings (i.e. the layer 0 hidden states)"""
+        return self.model.embeddings(input_ids=ids, token_type_ids=segments)
+
+    def extended_mask(self, mask, dtype):
+        """Returns the attention mask added to the attention scores"""
+        return (1.0 - mask[:, None, None, :].to(dtype)) * -10000.0
+
+    def forward_layer(self, ix, hidden, extended_mask):
+        """Computes the output of the ix-th transformer layer (0-based), so
+        that the layers can be computed one at a time (e.g. early exit)"""
+        layer = self.model.encoder.layer[ix]
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint(
+                lambda hidden, mask: layer(hidden, attention_mask=mask)[0],
+                hidden,
+                extended_mask,
+                use_reentrant=False,
+            )
+        return layer(hidden, attention_mask=extended_mask)[0]
 
     def tokenize(self, text):
         return self.tokenizer.tokenize(text)
 
+    def tokenize_function(self):
+        return self.tokenizer.tokenize
+
+    def tokenize_texts(self, texts: List[str]) -> List[List[str]]:
+        if not self.tokenizer.is_fast:
+            return super().tokenize_texts(texts)
+        encodings = self.tokenizer.backend_tokenizer.encode_batch(
+            texts, add_special_tokens=False
+        )
+        return [encoding.tokens for encoding in encodings]
+
+    def batch_encode(self, texts: List[str], maxlen=0):
+        """Tokenizes a batch of texts with the (rust) batch encoder of the
+        fast tokenizer, truncating the token IDs to maxlen tokens (0 for no
+        truncation)
+
+        Returns a dictionary with the (non truncated) tokens and lengths, as
+        `Vocab.batch_tokenize`, and the padded token IDs and attention mask
+        """
+        encodings = self.tokenizer.backend_tokenizer.encode_batch(
+            texts, add_special_tokens=False
+        )
+        tokens = [encoding.tokens for encoding in encodings]
+        lens = [len(encoding) for encoding in encodings]
+        if maxlen > 0:
+            for encoding, length in zip(encodings, lens):
+                if length > maxlen:
+                    encoding.truncate(maxlen)
+
+        tokids = self.pad(
+            np.fromiter(
+                chain.from_iterable(encoding.ids for encoding in encodings),
+                dtype=np.int64,
+            ),
+            lens,
+            maxlen=maxlen,
+        )
+        return {
+            "tokens": tokens,
+            "tokids": tokids,
+            "mask": (tokids != -1).long(),
+            "lens": lens,
+        }
+
+    def batch_tokenize(self, texts: List[str], batch_first=True, maxlen=0):
+        if not self.tokenizer.is_fast:
+            return super().batch_tokenize(texts, batch_first, maxlen)
+        encoded = self.batch_encode(texts, maxlen)
+        tokids = encoded["tokids"]
+        if not batch_first:
+            tokids = tokids.t().contiguous()
+        return encoded["tokens"], tokids, encoded["lens"]
+
     def tok2id(self, tok):
         return self.tokenizer.vocab[tok]
 
+    def tok2ids(self, toks):
+        return self.tokenizer.convert_tokens_to_ids(toks)
+
     def id2tok(self, idx):
         if torch.is_tensor(idx):
             if len(idx.shape) == 0:
@@ -61,116 +248,226 @@ class TransformerVocab(vocab.Vocab):
     def maxtokens(self) -> int:
         return 512
 
+    def dim(self) -> int:
+        return self.model.config.hidden_size
+
+    def emb_views(self) -> int:
+        if self.layer == -1:
+            return self.model.config.num_hidden_layers + 1
+        return 1
+
+    def static(self) -> bool:
+        return not self.trainable
+
 
 @config()
 class IndependentTransformerVocab(TransformerVocab):
-    """Encodes as [CLS] QUERY [SEP]"""
-
-    def _forward(self, in_toks, lens=None, seg_id=0):
-        if lens is None:
-            # if no lens provided, assume all are full length, I guess... not great
-            lens = torch.full_like(in_toks[:, 0], in_toks.shape[1])
-        maxlen = self.bert.config.max_position_embeddings
-        MAX_TOK_LEN = maxlen - 2  # -2 for [CLS] and [SEP]
-        toks, _ = util.subbatch(in_toks, MAX_TOK_LEN)
-        mask = util.lens2mask(lens, in_toks.shape[1])
-        mask, _ = util.subbatch(mask, MAX_TOK_LEN)
-        toks = torch.cat([torch.full_like(toks[:, :1], self.CLS), toks], dim=1)
-        toks = torch.cat([toks, torch.full_like(toks[:, :1], self.SEP)], dim=1)
-        ONES = torch.ones_like(mask[:, :1])
-        mask = torch.cat([ONES, mask, ONES], dim=1)
-        segment_ids = torch.full_like(toks, seg_id)
-        # Change -1 padding to 0-padding (will be masked)
-        toks = torch.where(toks == -1, torch.zeros_like(toks), toks)
-        result = self.bert(toks, segment_ids, mask)
-        if not self.vocab.last_layer:
-            cls_result = [r[:, 0] for r in result]
-            result = [r[:, 1:-1, :] for r in result]
-            result = [util.un_subbatch(r, in_toks, MAX_TOK_LEN) for r in result]
-        else:
-            BATCH = in_toks.shape[0]
-            result = result[-1]
-            cls_output = result[:, 0]
-            cls_result = []
-            for i in range(cls_output.shape[0] // BATCH):
-                cls_result.append(cls_output[i * BATCH : (i + 1) * BATCH])
-            cls_result = torch.stack(cls_result, dim=2).mean(dim=2)
-            result = result[:, 1:-1, :]
-            result = util.un_subbatch(result, in_toks, MAX_TOK_LEN)
-        return result, cls_result
-
-    def forward(self, in_toks, lens):
-        results, _ = self._forward(in_toks, lens)
+    """Encodes as [CLS] QUERY [SEP]
+
+    Queries and documents are encoded independently: when the vocabulary is
+    not trained, the document representations can be pre-computed (see
+    `EncodeCollection`) and read from the `encoded` store.
+
+    Args:
+
+    encoded: Pre-computed document representations
+    """
+
+    encoded: Option[Optional[EncodedCollection]] = None
+
+    def initialize(self):
+        super().initialize()
+        if self.encoded is not None:
+            assert not self.trainable, "Cannot use pre-computed documents when training"
+            assert self.layer != -1, "Pre-computed documents use a single layer"
+            meta = self.encoded.meta
+            assert (meta["model_id"], meta["layer"]) == (
+                self.model_id,
+                self.layer,
+            ), "The documents were encoded with another model"
+
+    def _forward(self, toks, lens=None, seg_id=0):
+        """Encodes the tokens by windows of (at most) maxtokens - 2 tokens
+        ([CLS] and [SEP] are added to each window)
+
+        Returns the token representations and the [CLS] representation
+        (averaged over the non empty windows)
+        """
+        BATCH, LEN = toks.shape
+        WINDOW = max(1, min(self.maxtokens() - 2, LEN))
+        windows, wlens, rows, positions = self.split(toks, WINDOW)
+
+        # [CLS] WINDOW [SEP] (the [SEP] follows the last non padding token)
+        ids = windows.new_zeros(len(windows), WINDOW + 2)
+        ids[:, 0] = self.CLS
+        ids[:, 1:-1] = windows.clamp(min=0)
+        ids[torch.arange(len(ids), device=ids.device), wlens + 1] = self.SEP
+        columns = torch.arange(WINDOW + 2, device=ids.device)
+        mask = (columns < (wlens + 2).unsqueeze(1)).long()
+
+        results, cls_results = [], []
+        for layer in self.encode_windows(ids, mask, torch.full_like(ids, seg_id)):
+            cls_results.append(self.aggregate(layer[:, 0], rows, BATCH))
+            results.append(self.unsplit(layer[:, 1:-1], rows, positions, BATCH, LEN))
+
+        if self.layer != -1:
+            return results[0], cls_results[0]
+        return results, cls_results
+
+    def forward(self, toks, lens=None):
+        results, _ = self._forward(toks, lens)
         return results
 
-    def enc_query_doc(self, **inputs):
-        result = {}
-        if "query_tok" in inputs and "query_len" in inputs:
-            query_results, query_cls = self._forward(
-                inputs["query_tok"], inputs["query_len"], seg_id=0
-            )
-            result.update({"query": query_results, "query_cls": query_cls})
-        if "doc_tok" in inputs and "doc_len" in inputs:
-            doc_results, doc_cls = self._forward(
-                inputs["doc_tok"], inputs["doc_len"], seg_id=1
-            )
-            result.update({"doc": doc_results, "doc_cls": doc_cls})
-        return result
+    def enc_query_doc(self, queries_tok, documents_tok, docids=None):
+        query, query_cls = vocab.unique_rows(
+            lambda toks: self._forward(toks, seg_id=0), queries_tok
+        )
+        if self.encoded is not None and docids is not None:
+            doc, doc_cls = self.encoded.batch(docids, documents_tok.shape[1])
+            doc, doc_cls = doc.to(query.device), doc_cls.to(query.device)
+        else:
+            doc, doc_cls = self._forward(documents_tok, seg_id=1)
+        return {"query": query, "query_cls": query_cls, "doc": doc, "doc_cls": doc_cls}
 
 
 @config()
 class JointTransformer(TransformerVocab):
-    """Encodes as [CLS] QUERY [SEP] DOCUMENT"""
-
-    def enc_query_doc(self, **inputs):
-        query_tok, query_len = inputs["query_tok"], inputs["query_len"]
-        doc_tok, doc_len = inputs["doc_tok"], inputs["doc_len"]
-        BATCH, QLEN = query_tok.shape
-        maxlen = self.bert.config.max_position_embeddings
-        MAX_DOC_TOK_LEN = maxlen - QLEN - 3  # -3 [CLS] and 2x[SEP]
-
-        doc_toks, sbcount = util.subbatch(doc_tok, MAX_DOC_TOK_LEN)
-        doc_mask = util.lens2mask(doc_len, doc_tok.shape[1])
-        doc_mask, _ = util.subbatch(doc_mask, MAX_DOC_TOK_LEN)
-
-        query_toks = torch.cat([query_tok] * sbcount, dim=0)
-        query_mask = util.lens2mask(query_len, query_toks.shape[1])
-        query_mask = torch.cat([query_mask] * sbcount, dim=0)
-
-        CLSS = torch.full_like(query_toks[:, :1], self.CLS)
-        SEPS = torch.full_like(query_toks[:, :1], self.SEP)
-        ONES = torch.ones_like(query_mask[:, :1])
-        NILS = torch.zeros_like(query_mask[:, :1])
-        toks = torch.cat([CLSS, query_toks, SEPS, doc_toks, SEPS], dim=1)
-        mask = torch.cat([ONES, query_mask, ONES, doc_mask, ONES], dim=1)
-        segment_ids = torch.cat(
-            [NILS] * (2 + QLEN) + [ONES] * (1 + doc_toks.shape[1]), dim=1
-        )
+    """Encodes as [CLS] QUERY [SEP] DOCUMENT [SEP]
+
+    Long documents are split into windows, each one being encoded along with
+    the query: the [CLS] representation is averaged over the (non empty)
+    windows of the document. The representations of the windows
+    (windows_cls) and their query-document pair index (rows) are also
+    returned.
+    """
+
+    def window_size(self, qlen: int, dlen: int) -> int:
+        """Number of document tokens in each window"""
+        return max(1, min(self.maxtokens() - qlen - 3, dlen))
+
+    def windows(self, queries_tok, documents_tok):
+        """Builds the transformer inputs ([CLS] QUERY [SEP] WINDOW [SEP]) of
+        the non empty document windows (see `split`)
 
-        # Change -1 padding to 0-padding (will be masked)
-        toks = torch.where(toks == -1, torch.zeros_like(toks), toks)
+        Returns the token IDs, the attention mask, the segment IDs, and for
+        each row the index of the query-document pair and of the window
+        """
+        QLEN = queries_tok.shape[1]
+        WINDOW = self.window_size(QLEN, documents_tok.shape[1])
+        docs, dlens, rows, positions = self.split(documents_tok, WINDOW)
+        queries = queries_tok.index_select(0, rows)
 
-        result = self.bert(toks, segment_ids, mask)
+        # The [SEP] follows the last document token
+        toks = docs.new_zeros(len(docs), QLEN + WINDOW + 3)
+        toks[:, 0] = self.CLS
+        toks[:, 1 : QLEN + 1] = queries.clamp(min=0)
+        toks[:, QLEN + 1] = self.SEP
+        toks[:, QLEN + 2 : -1] = docs.clamp(min=0)
+        toks[torch.arange(len(toks), device=toks.device), QLEN + 2 + dlens] = self.SEP
 
-        # extract relevant subsequences for query and doc
-        query_results = [r[:BATCH, 1 : QLEN + 1] for r in result]
-        doc_results = [r[:, QLEN + 2 : -1] for r in result]
-        doc_results = [
-            util.un_subbatch(r, doc_tok, MAX_DOC_TOK_LEN) for r in doc_results
-        ]
+        columns = torch.arange(toks.shape[1], device=toks.device)
+        mask = columns < (QLEN + 3 + dlens).unsqueeze(1)
+        mask[:, 1 : QLEN + 1] = queries != -1
+        segments = (columns >= QLEN + 2).long().expand_as(toks)
+        return toks, mask.long(), segments, rows, positions
+
+    def enc_query_doc(self, queries_tok, documents_tok, docids=None):
+        BATCH, QLEN = queries_tok.shape
+        DLEN = documents_tok.shape[1]
+        toks, mask, segments, rows, positions = self.windows(queries_tok, documents_tok)
+        first = positions == 0
+
+        result = {"query": [], "doc": [], "cls": [], "windows_cls": []}
+        for layer in self.encode_windows(toks, mask, segments):
+            result["cls"].append(self.aggregate(layer[:, 0], rows, BATCH))
+            result["windows_cls"].append(layer[:, 0])
+            result["query"].append(layer[first, 1 : QLEN + 1])
+            result["doc"].append(
+                self.unsplit(layer[:, QLEN + 2 : -1], rows, positions, BATCH, DLEN)
+            )
+
+        if self.layer != -1:
+            result = {key: value[0] for key, value in result.items()}
+        result["rows"] = rows
+        return result
+
+
+@pathoption("path", "encoded")
+@task()
+class EncodeCollection:
+    """Encodes (once) all the documents of an index with a (non trainable)
+    independent transformer
+
+    Attributes:
+        index: The index containing the documents
+        vocab: The transformer
+        maxlen: Maximum number of tokens kept for each document (should be
+            the document length of the scorers)
+        dtype: Type of the stored token representations (float16, or int8
+            with one scaling factor per token)
+        batch_size: Number of documents encoded at once
+    """
+
+    index: Param[Index]
+    vocab: Param[IndependentTransformerVocab]
+    maxlen: Param[int] = 2000
+    dtype: Param[str] = "float16"
+    batch_size: Option[int] = 16
+
+    def config(self):
+        return EncodedCollection(path=self.path)
+
+    def __validate__(self):
+        assert self.dtype in EncodedCollection.DTYPES, f"Unsupported type {self.dtype}"
+        assert self.vocab.layer != -1, "Only one layer can be stored"
+
+    def execute(self):
+        assert not self.vocab.trainable, "the transformer should not be trainable"
+        self.vocab.initialize()
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        dtypes = {"embeddings": EncodedCollection.DTYPES[self.dtype]}
+        if self.dtype == "int8":
+            dtypes["scales"] = np.float32
 
         cls_results = []
-        for layer in range(len(result)):
-            cls_output = result[layer][:, 0]
-            cls_result = []
-            for i in range(cls_output.shape[0] // BATCH):
-                cls_result.append(cls_output[i * BATCH : (i + 1) * BATCH])
-            cls_result = torch.stack(cls_result, dim=2).mean(dim=2)
-            cls_results.append(cls_result)
-
-        if self.vocab.last_layer:
-            query_results = query_results[-1]
-            doc_results = doc_results[-1]
-            cls_results = cls_results[-1]
-
-        return {"query": query_results, "doc": doc_results, "cls": cls_results}
+        with RaggedStore.writer(self.path, **dtypes) as writer:
+
+            def encode(batch):
+                toks, tokids, lens = self.vocab.batch_tokenize(
+                    [text for _, text in batch], maxlen=self.maxlen
+                )
+                with torch.no_grad():
+                    results, cls = self.vocab._forward(tokids, seg_id=1)
+
+                for (docid, _), result, length in zip(batch, results, lens):
+                    result = result[: min(length, self.maxlen)].float().numpy()
+                    if self.dtype == "int8":
+                        scales = np.abs(result).max(1) / 127.0
+                        scales[scales == 0] = 1.0
+                        result = np.round(result / scales[:, None])
+                        writer.add(docid, embeddings=result, scales=scales)
+                    else:
+                        writer.add(docid, embeddings=result)
+                cls_results.append(cls.float().numpy().astype(np.float16))
+
+            batch = []
+            for docid in tqdm(self.index.docids(), total=self.index.documentcount):
+                batch.append((docid, self.index.document_text(docid)))
+                if len(batch) >= self.batch_size:
+                    encode(batch)
+                    batch = []
+            if batch:
+                encode(batch)
+
+        np.save(self.path / "cls.npy", np.concatenate(cls_results))
+        meta = {
+            "model_id": self.vocab.model_id,
+            "layer": self.vocab.layer,
+            "maxlen": self.maxlen,
+            "dtype": self.dtype,
+            "dim": self.vocab.dim(),
+        }
+        with (self.path / "meta.json").open("wt") as fp:
+            json.dump(meta, fp)
+        logging.info("Encoded %d documents", len(writer.docids))
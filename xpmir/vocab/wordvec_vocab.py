@@ -1,12 +1,13 @@
 import os
 import pickle
 import hashlib
+from itertools import repeat
 from typing import List, Optional
 import numpy as np
 import torch
 from pathlib import Path
 from torch import nn
-from experimaestro import config, param, cache, Param
+from experimaestro import config, param, cache, Param, Option
 
 # from onir import vocab, util
 from xpmir.letor import Random
@@ -44,27 +45,43 @@ class WordvecVocab(Vocab, nn.Module):
     Args:
 
     train: Should the word embeddings be re-retrained?
+    sparse_grad: Use sparse gradients when learning the embeddings (to be
+        used with an optimizer supporting them, e.g. SparseAdam)
     """
 
     data: Param[WordEmbeddings]
     learn: Param[bool] = False
     random: Param[Optional[Random]]
+    sparse_grad: Option[bool] = False
 
     """
     A word vector vocabulary that supports standard pre-trained word vectors
     """
 
-    def __postinit__(self):
-        super().__postinit__()
-        self._terms, self._weights = self.load()
-        self._term2idx = {t: i for i, t in enumerate(self._terms)}
-        matrix = self._weights
+    _term2idx = None
+    _weights = None
+
+    def initialize_tokenizer(self):
+        # Only the terms are loaded (not the embeddings)
+        if self._term2idx is None:
+            terms, _ = self.load(weights=False)
+            self.set_terms(terms)
+
+    def initialize(self):
+        super().initialize()
+        if self._weights is not None:
+            return
+        terms, self._weights = self.load()
+        self.set_terms(terms)
+        matrix = self.weights()
         self.size = matrix.shape[1]
         matrix = np.concatenate(
             [np.zeros((1, self.size)), matrix]
         )  # add padding record (-1)
         self.embed = nn.Embedding.from_pretrained(
-            torch.from_numpy(matrix.astype(np.float32)), freeze=not self.learn
+            torch.from_numpy(matrix.astype(np.float32)),
+            freeze=not self.learn,
+            sparse=self.learn and self.sparse_grad,
         )
 
     def __validate__(self):
@@ -72,12 +89,20 @@ class WordvecVocab(Vocab, nn.Module):
         if self.learn:
             assert self.random is not None
 
+    def set_terms(self, terms: List[str]):
+        self._terms = terms
+        self._term2idx = {t: i for i, t in enumerate(self._terms)}
+
+    def weights(self) -> np.ndarray:
+        """Returns the embedding matrix (one row per term)"""
+        return self._weights
+
     @cache("terms.npy")
-    def load(self, path: Path):
+    def load(self, path: Path, weights=True):
         path_lst = path.with_suffix(".lst")
         if path.is_file():
             with path_lst.open("rb") as fp:
-                return pickle.load(fp), np.load(path)
+                return pickle.load(fp), np.load(path) if weights else None
 
         terms, weights = self.data.load()
         np.save(path, weights)
@@ -88,6 +113,9 @@ class WordvecVocab(Vocab, nn.Module):
     def tok2id(self, tok):
         return self._term2idx[tok]
 
+    def tok2ids(self, toks):
+        return list(map(self._term2idx.__getitem__, toks))
+
     def id2tok(self, idx):
         return self._terms[idx]
 
@@ -97,6 +125,9 @@ class WordvecVocab(Vocab, nn.Module):
     def dim(self):
         return self.embed.weight.shape[0]
 
+    def static(self):
+        return not self.learn
+
     def forward(self, toks, lens=None):
         # lens ignored
         return self.embed(toks + 1)  # +1 to handle padding at position -1
@@ -108,19 +139,21 @@ class WordvecUnkVocab(WordvecVocab):
     A vocabulary in which all unknown terns are given the same token (UNK; 0), with random weights
     """
 
-    def __postinit__(self):
-        super().__postinit__()
-        self._terms = [None] + self._terms
-        for term in self._term2idx:
-            self._term2idx[term] += 1
+    def set_terms(self, terms: List[str]):
+        super().set_terms([None] + terms)
+
+    def weights(self) -> np.ndarray:
         unk_weights = self.random.state.normal(
             scale=0.5, size=(1, self._weights.shape[1])
         )
-        self._weights = np.concatenate([unk_weights, self._weights])
+        return np.concatenate([unk_weights, self._weights])
 
     def tok2id(self, tok):
         return self._term2idx.get(tok, 0)
 
+    def tok2ids(self, toks):
+        return list(map(self._term2idx.get, toks, repeat(0)))
+
     def lexicon_path_segment(self):
         return "{base}_unk".format(base=super().lexicon_path_segment())
 
@@ -137,11 +170,11 @@ class WordvecHashVocab(WordvecVocab):
     their hash value. Each position is assigned its own random weight.
     """
 
-    def initialize(self, random):
-        hash_weights = random.normal(
-            scale=config["init_stddev"], size=(self.hashspace, self._weights.shape[1])
+    def weights(self) -> np.ndarray:
+        hash_weights = self.random.state.normal(
+            scale=self.init_stddev, size=(self.hashspace, self._weights.shape[1])
         )
-        self._weights = np.concatenate([self._weights, hash_weights])
+        return np.concatenate([self._weights, hash_weights])
 
     def tok2id(self, tok):
         try:
@@ -155,5 +188,8 @@ class WordvecHashVocab(WordvecVocab):
             item_hash_pos = item_hash % self.hashspace
             return len(self._terms) + item_hash_pos
 
+    def tok2ids(self, toks):
+        return [self.tok2id(tok) for tok in toks]
+
     def lexicon_size(self) -> int:
         return len(self._terms) + self.hashspace